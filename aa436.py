@@ -49,10 +49,21 @@ import re
 import select
 import string
 import subprocess
+import signal
+import concurrent.futures
 import logging
 import logging.handlers
+import ctypes
+import ctypes.util
+import struct
+import zlib
+import base64
+import glob
+import collections
 from socket import *
 
+import stats436
+
 
 
 
@@ -61,373 +72,2105 @@ from socket import *
 # the queue of updates to sent to the server etc.
 
 file_consumer_list = []
+file_tailer_hash = {}
+file_target_hash = {}
+max_open_files = 256
+read_chunk_size = 65536
+read_budget_bytes = 1048576
+read_budget_lines = 10000
+file_events = 'poll'
+file_watcher = None
+active_schedule_hash = {}
 host_name = os.uname()[1]
 ps_command = []
 process_list = []
+process_count = None
 uid_seed = 0
 alert_queue = []
 cmd_list = []
+run_pool = None
+run_workers = 4
+killed_commands = []
+alert_window = 64
+alert_datagram_size = 1400
+alert_retry_interval = 10
+spool = None
+spool_memory = 256
+spool_max_size = 134217728
+spool_segment_size = 65536
+spool_compact_size = 1048576
+spool_compact_step = 1048576
+spool_alert_size = 8192
+spool_save_interval = 5
+metric_window = 0
+metric_hash = {}
+next_metric_flush = 0
+stats_interval = 0
+file_offsets = {}
+offsets_saved = ''
+resume_limit = 10485760
 logger = logging.getLogger(__name__)
 
 
 
 
-# Return True if current time is within range
-# given in active_string (format: day_numbers;HH:MM-HH:MM, ...).
+# The Agent keeps statistics about it's own performance (see stats436.py).
+# They can be fetched with a "STATS" datagram to the Agent's stats port
+# (127.0.0.1, Agent port + 2), or sent to the Server as SYSTEM metrics (see
+# "stats_interval:").
+
+stats = stats436.stats_collector()
+
 
-def is_active(active_string):
-  if(len(active_string) == 0):
-    actv = True
 
-  else:
-    actv = False
-    ltm = time.localtime()
+
+# An active_schedule is an "active:" expression (format:
+# day_numbers;HH:MM-HH:MM, ...) compiled into a bitmap with an entry for
+# every minute of the week.  The answer for the current minute is cached,
+# so most checks only cost a call to time.time().  Rules with the same
+# expression share one active_schedule (see get_schedule()).
+
+class active_schedule:
+  def __init__(self, active_string):
+    self.active_string = active_string
+    self.minutes = bytearray(7 * 1440)
+    self.minute = -1
+    self.actv = True
 
     for t in active_string.split(','):
       tmt = re.match('^([0-9]+);(\d+):(\d+)\-(\d+):(\d+)$', t)
 
-      if tmt:
-        if(((ltm[3] * 60) + ltm[4]) >= ((int(tmt.group(2)) * 60) + int(tmt.group(3))) and ((ltm[3] * 60) + ltm[4]) <= ((int(tmt.group(4)
-) * 60) + int(tmt.group(5)))):
-          if(tmt.group(1).find(str(ltm[6])) > -1):
-            actv = True
+      if tmt:
+        start = (int(tmt.group(2)) * 60) + int(tmt.group(3))
+        end = min((int(tmt.group(4)) * 60) + int(tmt.group(5)), 1439)
+
+        for day in set(tmt.group(1)):
+          if(day in '0123456' and start <= end):
+            self.minutes[(int(day) * 1440) + start:(int(day) * 1440) + end + 1] = b'\x01' * (end + 1 - start)
+
+
+
+  def __repr__(self):
+    return(self.active_string)
+
+
+
+  # Returns True if the current time is within the schedule.  Day
+  # numbers are matched against time.localtime()'s tm_wday.
+
+  def is_active(self):
+    if(len(self.active_string) > 0):
+      minute = int(time.time()) // 60
+
+      if(minute != self.minute):
+        ltm = time.localtime()
+        self.actv = (self.minutes[(ltm[6] * 1440) + (ltm[3] * 60) + ltm[4]] == 1)
+        self.minute = minute
+
+    return(self.actv)
+
+
+
+
+# Returns the (shared) active_schedule for an "active:" expression.
+
+def get_schedule(active_string):
+  global active_schedule_hash
+
+  if(active_string not in active_schedule_hash):
+    active_schedule_hash[active_string] = active_schedule(active_string)
+
+  return(active_schedule_hash[active_string])
+
+
+
+
+# Return True if current time is within the range
+# given by an active_schedule.
+
+def is_active(schedule):
+  return(schedule.is_active())
+
+
+
+
+# A pattern_matcher holds the "match:" patterns of a file consumer, compiled
+# once when the configuration is loaded.  Where possible, all of the patterns
+# are merged into a single regular expression so that each log line is
+# scanned in one pass, rather than once per pattern.  Patterns which can't
+# safely be merged (eg. those using numbered back-references, or inline flags)
+# are searched one by one instead.
+
+class pattern_matcher:
+  def __init__(self, matches):
+    global logger
+
+    self.patterns = []
+    self.combined = None
+
+    for m in matches:
+      try:
+        self.patterns += [ re.compile(m) ]
+
+      except re.error:
+        logger.error('Error: Invalid pattern '+m)
+
+    if(len(self.patterns) == 1):
+      self.combined = self.patterns[0]
+
+    elif(len(self.patterns) > 1 and not any(re.search(r'\\[1-9]', p.pattern) for p in self.patterns)):
+      try:
+        self.combined = re.compile('|'.join([ '(?:' + p.pattern + ')' for p in self.patterns ]))
+
+      except re.error:
+        self.combined = None
+
+
+
+  # Returns True if any of the patterns match the given line.
+
+  def search(self, line):
+    if self.combined is not None:
+      return(self.combined.search(line) is not None)
+
+    for p in self.patterns:
+      if(p.search(line) is not None):
+        return(True)
+
+    return(False)
+
+
+
+# A process_counter counts how many running processes match each of the
+# "process:" patterns.  Each process is first checked against all of the
+# patterns merged into one pattern_matcher, and only those which match it
+# are checked against the patterns one by one.
+#
+# Processes are either read from the output of ps_command, or, if the
+# ps_command is "builtin=proc" (Linux), straight from /proc/<pid>/cmdline
+# (kernel threads, which have no command line, are shown as "[name]" as
+# they are by ps).  When reading /proc, the patterns matched by each pid
+# are remembered while the pid's start time and name (comm, which changes
+# when the process exec()s another program) stay the same, so only new
+# processes need their command line read and matched.  Remembered matches
+# are also dropped after [pid_cache_age] seconds, in case a process has
+# changed it's command line without it's name changing.
+
+pid_cache_age = 300
+
+class process_counter:
+  def __init__(self, patterns):
+    self.prefilter = pattern_matcher(patterns)
+    self.patterns = [ pattern_matcher([ p ]) for p in patterns ]
+    self.pid_hash = {}
+
+
+
+  # Returns the indexes of the patterns which match a process.
+
+  def match(self, line):
+    if(self.prefilter.search(line) == False):
+      return(())
+
+    return(tuple([ i for i in range(len(self.patterns)) if self.patterns[i].search(line) ]))
+
+
+
+  # Counts matches in the output lines of ps_command.
+
+  def count_lines(self, lines):
+    counts = [ 0 ] * len(self.patterns)
+
+    for line in lines:
+      for i in self.match(line):
+        counts[i] += 1
+
+    return(counts)
+
+
+
+  # Counts matches in /proc.
+
+  def count_proc(self):
+    counts = [ 0 ] * len(self.patterns)
+    seen = {}
+    now = time.time()
+
+    for pid in os.listdir('/proc'):
+      if pid.isdigit():
+        try:
+          sf = open('/proc/'+pid+'/stat', 'rb')
+          stat = sf.read()
+          sf.close()
+          start = stat.rsplit(b')', 1)[1].split()[19]
+          comm = stat[stat.find(b'(') + 1:stat.rfind(b')')]
+          cached = self.pid_hash.get(pid)
+
+          if(cached is None or cached[0] != start or cached[1] != comm or now > cached[3] + pid_cache_age):
+            cf = open('/proc/'+pid+'/cmdline', 'rb')
+            cmdline = cf.read().replace(b'\0', b' ').strip()
+            cf.close()
+
+            if(len(cmdline) == 0):
+              cmdline = b'[' + comm + b']'
+
+            cached = [ start, comm, self.match(cmdline.decode('utf-8', 'replace')), now ]
+
+          seen[pid] = cached
+
+          for i in cached[2]:
+            counts[i] += 1
+
+        except (OSError, IndexError):
+          pass
+
+    self.pid_hash = seen
+
+    return(counts)
+
+
+
+
+# An instance of file_tailer is created for each log file being followed.
+# All of the file consumers watching the same file share a single
+# file_tailer, so each line is read and decoded only once and then passed
+# on to every consumer.  Logic to deal with log files "rolling" is
+# contained here.
+#
+# Files are read in large binary chunks which are split into lines in
+# bulk.  An incomplete line at the end of a chunk is held over until the
+# rest of it is written.  Each call to read() stops once the read budget
+# is used up, so that a large backlog can't stall the rest of the main
+# loop - "backlog" is set to True if there is more data waiting to be
+# read.  The budget ([ bytes, lines ], from read_budget_bytes /
+# read_budget_lines) is passed in by the main loop, which shares it
+# between all of the files on each pass.
+#
+# With a state folder, the position reached in each file is saved every
+# few seconds (see save_offsets()).  When a restarted Agent first opens a
+# file, it carries on from the saved position (see resume()), rather than
+# skipping to the end of the file.
+#
+# The number of files held open is limited by tailer_pool (see
+# file_pool).  A file_tailer closed by the pool is "parked" - it keeps
+# the inode and offset it had reached, and the file is only re-opened
+# once something has been written to it.
+
+class file_tailer:
+  def __init__(self, filename):
+    global logger
+
+    self.open = False
+    self.filename = filename
+    self.seek = 2
+    self.partial = b''
+    self.parked = None
+    self.backlog = False
+    self.dirty = True
+    self.watched = False
+    self.consumers = []
+
+    logger.info('Creating file tailer for file '+filename)
+
+
+
+  # Returns the ( inode, offset ) reached in the file (the offset being
+  # the start of any incomplete line held over), or None if the file
+  # hasn't been opened.
+
+  def position(self):
+    if(self.open == True):
+      return(( self.inode, self.fd.tell() - len(self.partial) ))
+
+    elif self.parked is not None:
+      return(( self.parked[0], self.parked[1] - len(self.partial) ))
+
+    return(None)
+
+
+
+  # Closes the file to free it's descriptor, keeping the inode and the
+  # offset read up to (the file's size when it was last read), so reading
+  # carries on from there.  Any incomplete line is held on to.
+
+  def park(self):
+    if(self.open == True):
+      self.parked = ( self.inode, self.fd.tell() )
+      self.fd.close()
+      self.open = False
+
+    tailer_pool.remove(self)
+
+
+
+  # Seeks back to the offset reached before the file was parked.  If the
+  # file has been rolled or truncated since, it is read from the start
+  # (and any incomplete line from before is dropped).
+
+  def unpark(self):
+    global logger
+
+    inode, offset = self.parked
+    self.parked = None
+
+    if(inode != self.inode or offset > self.st.st_size):
+      logger.info('File '+self.filename+' was rolled or truncated while closed (reading from the start)')
+      offset = 0
+      self.partial = b''
+
+    self.fd.seek(offset)
+
+
+
+  # Seeks to the position saved by a previous run of the Agent.  If the
+  # file has since been rolled or truncated, it is read from the start.
+  # At most [resume_limit] bytes are read from the end of the file - if
+  # that means starting part way through a line, the rest of that line
+  # is skipped.
+
+  def resume(self):
+    global logger
+
+    inode, offset = file_offsets.pop(self.filename)
+
+    if(inode != self.inode or offset > self.st.st_size):
+      offset = 0
+
+    start = max(offset, self.st.st_size - resume_limit)
+
+    if(start > offset):
+      logger.info('Skipping '+str(start - offset)+' bytes of '+self.filename+' (over the resume limit)')
+      self.fd.seek(start - 1)
+
+      if(self.fd.read(1) != b'\n'):
+        self.fd.readline()
+
+    else:
+      self.fd.seek(start)
+
+    logger.info('Resuming '+self.filename+' from offset '+str(self.fd.tell()))
+
+
+
+  # Closes the file being followed - this happens when the file is no
+  # longer monitored after an aa436.py Agent is reconfigured.
+
+  def close(self):
+    global logger
+
+    if(self.open == True):
+      self.fd.close()
+      self.open = False
+
+    tailer_pool.remove(self)
+
+    logger.info('Removing file tailer for file '+self.filename)
+
+
+
+  # Returns a list of the lines added to the file since the last call,
+  # taking what is read from [budget] (a whole budget if it is None).
+
+  def read(self, budget = None):
+    global logger
+    global read_budget_bytes
+    global read_budget_lines
+
+    if budget is None:
+      budget = [ read_budget_bytes, read_budget_lines ]
+
+    lines = []
+    self.backlog = False
+    self.dirty = False
+
+    while(True):
+      if(self.open == False):
+        try:
+          self.st = os.stat(self.filename)
+
+          # Nothing has been written to a parked file.
+          if(self.parked == ( self.st.st_ino, self.st.st_size )):
+            break
+
+          self.inode = self.st.st_ino
+          self.fd = open(self.filename, 'rb', buffering = 0)
+
+          if self.parked is not None:
+            self.unpark()
+
+          elif(self.seek == 2 and self.filename in file_offsets):
+            self.resume()
+            self.partial = b''
+
+          else:
+            self.fd.seek(0, self.seek)
+            self.partial = b''
+
+          self.open = True
+          self.seek = 0
+          tailer_pool.add(self)
+
+        except Exception:
+          logger.error('Error: File '+self.filename+' not found')
+          break
+
+      else:
+        chunk = self.fd.read(min(read_chunk_size, budget[0]))
+
+        if chunk:
+          tailer_pool.touch(self)
+          budget[0] -= len(chunk)
+          chunk = self.partial + chunk
+          eol = chunk.rfind(b'\n')
+
+          if(eol > -1):
+            chunk_lines = chunk[:eol].decode('utf-8', 'replace').split('\n')
+            lines.extend(chunk_lines)
+            budget[1] -= len(chunk_lines)
+            self.partial = chunk[eol + 1:]
+
+          else:
+            self.partial = chunk
+
+          if(budget[0] <= 0 or budget[1] <= 0):
+            self.backlog = True
+            break
+
+        else:
+          try:
+            self.st = os.stat(self.filename)
+
+            if(self.st.st_ino != self.inode):
+              if(len(self.partial) > 0):
+                lines.append(self.partial.decode('utf-8', 'replace'))
+
+              self.fd.close()
+              self.open = False
+              tailer_pool.remove(self)
+
+            else:
+              break
+
+          except Exception:
+            logger.error('Error: File '+self.filename+' not found')
+            break
+
+    return(lines)
+
+
+
+
+# A file_pool limits the number of log files held open at once to
+# [max_open_files], so that thousands of files can be followed within a
+# fixed number of descriptors.  Open file tailers are kept in least
+# recently used order (a file tailer is "used" when it reads something
+# from it's file).  Opening a file beyond the limit parks the file tailer
+# which has gone longest without reading anything.
+
+class file_pool:
+  def __init__(self):
+    self.tailers = collections.OrderedDict()
+
+
+
+  def add(self, ft):
+    self.tailers[ft] = True
+    self.tailers.move_to_end(ft)
+    self.trim()
+
+
+
+  def touch(self, ft):
+    if(ft in self.tailers):
+      self.tailers.move_to_end(ft)
+
+
+
+  def remove(self, ft):
+    self.tailers.pop(ft, None)
+
+
+
+  # Parks file tailers until no more than [max_open_files] are open.
+
+  def trim(self):
+    while(len(self.tailers) > max(max_open_files, 1)):
+      next(iter(self.tailers)).park()
+
+
+
+
+tailer_pool = file_pool()
+
+
+
+
+# An inotify_watcher uses the Linux inotify interface to find out when
+# followed log files are modified or rolled, so that the main loop only
+# reads files which have changed.  The folders holding the files are
+# watched, rather than the files themselves, so that files being created,
+# renamed or deleted are noticed too.  The watcher is added to the main
+# loop's select() list, and marks file tailers as "dirty" when events
+# arrive for their files.
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+class inotify_watcher:
+  def __init__(self):
+    global logger
+
+    self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+    self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+    if(self.fd < 0):
+      raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+
+    self.wd_hash = {}
+    self.folder_hash = {}
+    self.tailer_hash = {}
+    self.target_hash = {}
+
+    logger.info('Watching log files using inotify')
+
+
+
+  def fileno(self):
+    return(self.fd)
+
+
+
+  def close(self):
+    os.close(self.fd)
+
+
+
+  # Starts watching a folder, if it isn't already.  Returns False if the
+  # folder can't be watched (eg. it doesn't exist yet).
+
+  def watch_folder(self, folder):
+    if(folder not in self.folder_hash):
+      wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+      if(wd < 0):
+        return(False)
+
+      self.wd_hash[wd] = folder
+      self.folder_hash[folder] = wd
+
+    return(True)
+
+
+
+  # Starts watching the folder containing a file tailer's file.  If the
+  # folder can't be watched, the file tailer is left to be polled.
+
+  def add(self, ft):
+    global logger
+
+    folder = os.path.dirname(ft.filename) or '.'
+    name = os.path.basename(ft.filename)
+
+    if(self.watch_folder(folder) == False):
+      logger.error('Error: Unable to watch folder '+folder+' (polling '+ft.filename+')')
+      ft.watched = False
+      return
+
+    tailers = self.tailer_hash.setdefault((folder, name), [])
+
+    if(ft not in tailers):
+      tailers.append(ft)
+
+    ft.watched = True
+    ft.dirty = True
+
+
+
+  # Stops passing events for a file tailer's file to it (the folder is
+  # still watched, for any other files in it).
+
+  def remove(self, ft):
+    folder = os.path.dirname(ft.filename) or '.'
+    name = os.path.basename(ft.filename)
+
+    if(ft in self.tailer_hash.get((folder, name), [])):
+      self.tailer_hash[(folder, name)].remove(ft)
+
+
+
+  # Starts watching the folder a file_target finds it's files in, so that
+  # files being created, renamed or deleted there are noticed straight
+  # away.  Targets whose folder names contain wildcards are left to be
+  # checked every few seconds.
+
+  def add_target(self, target):
+    global logger
+
+    if(target.folder is None or self.watch_folder(target.folder) == False):
+      target.watched = False
+      return
+
+    targets = self.target_hash.setdefault(target.folder, [])
+
+    if(target not in targets):
+      targets.append(target)
+
+    target.watched = True
+    target.dirty = True
+
+
+
+  def remove_target(self, target):
+    if(target in self.target_hash.get(target.folder, [])):
+      self.target_hash[target.folder].remove(target)
+
+
+
+  # Reads pending inotify events, marking the file tailers they refer
+  # to as dirty.
+
+  def read(self):
+    try:
+      data = os.read(self.fd, 65536)
+
+    except BlockingIOError:
+      return
+
+    pos = 0
+
+    while(pos < len(data)):
+      wd, mask, cookie, nlen = struct.unpack_from('iIII', data, pos)
+      name = os.fsdecode(data[pos + 16:pos + 16 + nlen].rstrip(b'\0'))
+      pos += 16 + nlen
+
+      # Events were lost, so every file has to be checked.
+      if(mask & IN_Q_OVERFLOW):
+        for tailers in self.tailer_hash.values():
+          for ft in tailers:
+            ft.dirty = True
+
+        for targets in self.target_hash.values():
+          for target in targets:
+            target.dirty = True
+
+      # The folder has gone - fall back to polling its files.
+      elif(mask & IN_IGNORED):
+        if(wd in self.wd_hash):
+          folder = self.wd_hash.pop(wd)
+          del self.folder_hash[folder]
+
+          for key in [ k for k in self.tailer_hash if k[0] == folder ]:
+            for ft in self.tailer_hash.pop(key):
+              ft.watched = False
+
+          for target in self.target_hash.pop(folder, []):
+            target.watched = False
+
+      elif(wd in self.wd_hash):
+        for ft in self.tailer_hash.get((self.wd_hash[wd], name), []):
+          ft.dirty = True
+
+        # Files have appeared in (or gone from) the folder.
+        if(mask & (IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE)):
+          for target in self.target_hash.get(self.wd_hash[wd], []):
+            target.dirty = True
+
+
+
+
+# Starts watching all followed log files (and the folders of globs and
+# folders given to "file:"), if the Agent has been configured to use
+# inotify.  Falls back to polling if inotify isn't available.
+
+def watch_files():
+  global file_events
+  global file_watcher
+  global file_tailer_hash
+  global logger
+
+  if(file_events == 'inotify' and file_watcher is None):
+    try:
+      file_watcher = inotify_watcher()
+
+    except Exception:
+      logger.error('Error: inotify is not available (polling log files instead)')
+      file_events = 'poll'
+
+  if file_watcher is not None:
+    for ft in file_tailer_hash.values():
+      file_watcher.add(ft)
+
+    for target in file_target_hash.values():
+      file_watcher.add_target(target)
+
+
+
+
+# The positions reached in log files are kept in aa436.offsets in the
+# Agent's state folder, one file per line: "inode offset filename".
+# load_offsets() reads them when the Agent starts.  save_offsets() is
+# called every few seconds from the main loop, and only writes the file
+# if something has changed.  It writes a new copy and renames it over the
+# old one, so the file is never left half-written.  Saved positions not
+# used yet (eg. before the Agent has been sent it's configuration) are
+# kept until the Agent is configured - do_config() then drops those for
+# files which are no longer followed.
+
+def load_offsets(folder):
+  global file_offsets
+  global offsets_saved
+  global logger
+
+  try:
+    with open(os.path.join(folder, 'aa436.offsets')) as f:
+      offsets_saved = f.read()
+
+  except OSError:
+    offsets_saved = ''
+
+  for ol in offsets_saved.split('\n'):
+    om = re.match('^(\d+) (\d+) (.+)$', ol)
+
+    if om:
+      file_offsets[om.group(3)] = ( int(om.group(1)), int(om.group(2)) )
+
+  logger.info('Loaded saved positions for '+str(len(file_offsets))+' log files')
+
+
+
+def save_offsets(folder):
+  global offsets_saved
+  global logger
+
+  positions = dict(file_offsets)
+
+  for ft in file_tailer_hash.values():
+    if ft.position() is not None:
+      positions[ft.filename] = ft.position()
+
+  data = ''.join([ str(positions[f][0])+' '+str(positions[f][1])+' '+f+'\n' for f in sorted(positions) ])
+
+  if(data != offsets_saved):
+    try:
+      with open(os.path.join(folder, 'aa436.offsets.tmp'), 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+      os.replace(os.path.join(folder, 'aa436.offsets.tmp'), os.path.join(folder, 'aa436.offsets'))
+      offsets_saved = data
+
+    except OSError as e:
+      logger.error('Error: Unable to save log file positions: '+str(e))
+
+
+
+
+# Returns the file_tailer for the given file, creating one if this is
+# the first file consumer to follow the file.
+
+def get_file_tailer(filename):
+  global file_tailer_hash
+
+  if(filename not in file_tailer_hash):
+    file_tailer_hash[filename] = file_tailer(filename)
+
+  return(file_tailer_hash[filename])
+
+
+
+
+# As well as a single log file, "file:" can name a glob (eg.
+# /var/log/app/*.log) or a folder, in which case every file matching the
+# glob, or in the folder, is followed.  An instance of file_target is
+# created for each glob or folder.  It finds the files which match (see
+# discover()), and gives each of them a file_tailer which passes lines on
+# to the target's file consumers.  The main loop calls discover() every
+# few seconds, or as soon as inotify reports a change to the folder.
+#
+# Files found when a target is first set up are followed from their end
+# (or from a saved position), the same as single files.  Files which
+# appear later are read from the start, so nothing written to them is
+# missed - unless they are a renamed copy of a file which was already
+# being followed (eg. a rolled log), which are followed from their end.
+# Files which have gone are closed.
+
+class file_target:
+  def __init__(self, pattern):
+    global logger
+
+    self.pattern = pattern
+    self.consumers = []
+    self.files = None
+    self.dirty = True
+    self.watched = False
+
+    # The folder to watch with inotify (None if the folder names contain
+    # wildcards).
+    if os.path.isdir(pattern):
+      self.folder = pattern
+
+    elif(re.search('[*?[]', os.path.dirname(pattern)) is None):
+      self.folder = os.path.dirname(pattern) or '.'
+
+    else:
+      self.folder = None
+
+    logger.info('Creating file target for '+pattern)
+
+
+
+  # Returns the files currently in the folder, or matching the glob.
+
+  def expand(self):
+    try:
+      if os.path.isdir(self.pattern):
+        names = [ os.path.join(self.pattern, name) for name in os.listdir(self.pattern) ]
+
+      else:
+        names = glob.glob(self.pattern)
+
+    except OSError:
+      names = []
+
+    return(sorted([ name for name in names if os.path.isfile(name) ]))
+
+
+
+  # Brings the set of files followed up to date, and makes sure every
+  # file's tailer passes lines to all of the target's consumers.
+
+  def discover(self):
+    global file_tailer_hash
+    global file_watcher
+    global logger
+
+    self.dirty = False
+    found = {}
+
+    for filename in self.expand():
+      try:
+        found[filename] = os.stat(filename).st_ino
+
+      except OSError:
+        pass
+
+    seen_inodes = set(found.values() if self.files is None else self.files.values())
+
+    for filename in found:
+      if(filename not in file_tailer_hash):
+        ft = get_file_tailer(filename)
+
+        if(self.files is not None and found[filename] not in seen_inodes):
+          logger.info('New file '+filename+' (reading from the start)')
+          ft.seek = 0
+
+        if file_watcher is not None:
+          file_watcher.add(ft)
+
+      ft = file_tailer_hash[filename]
+
+      for fc in self.consumers:
+        if(fc not in ft.consumers):
+          ft.consumers.append(fc)
+
+    for filename in [ f for f in (self.files or {}) if f not in found and f in file_tailer_hash ]:
+      ft = file_tailer_hash[filename]
+      ft.consumers = [ fc for fc in ft.consumers if fc not in self.consumers ]
+
+      if(len(ft.consumers) == 0):
+        if file_watcher is not None:
+          file_watcher.remove(ft)
+
+        file_tailer_hash.pop(filename).close()
+
+    self.files = found
+
+
+
+
+# Returns whether a "file:" directive names a glob or folder, rather than
+# a single file.  An existing file is always followed as it is named, even
+# if the name contains wildcard characters (eg. "app[1].log").
+
+def is_file_pattern(filename):
+  if os.path.isfile(filename):
+    return(False)
+
+  return(os.path.isdir(filename) or re.search('[*?[]', filename) is not None)
+
+
+
+def get_file_target(pattern):
+  global file_target_hash
+
+  if(pattern not in file_target_hash):
+    file_target_hash[pattern] = file_target(pattern)
+
+  return(file_target_hash[pattern])
+
+
+
+# Connects a file consumer to the file_tailer for it's file, or to the
+# file_target for it's glob or folder.
+
+def attach_consumer(fc):
+  if is_file_pattern(fc.filename):
+    target = get_file_target(fc.filename)
+    target.consumers.append(fc)
+    target.dirty = True
+
+  else:
+    get_file_tailer(fc.filename).consumers.append(fc)
+
+
+
+
+# An instance of file_consumer is created for each file
+# tracking configuration.
+
+class file_consumer:
+  def __init__(self, filename, matches, actions, exceeds):
+    global logger
+
+    self.filename = filename
+    self.matches = matches
+    self.matcher = pattern_matcher(matches)
+    self.tags = actions['tags']
+    self.message = ''
+    self.active = get_schedule('')
+    self.list = []
+
+    logger.info('Creating file consumer for file '+filename+' (patterns: '+str(matches)+', '+str(actions)+')')
+
+    if('message' in actions):
+      self.message = actions['message']
+
+    self.period = 0
+
+    if('period' in actions):
+      self.period = int(actions['period'])
+
+    self.threshold = 0
+
+    if('threshold' in actions):
+      self.threshold = int(actions['threshold'])
+
+    self.count = 0
+    self.next_report = time.time() + self.period
+
+    # With "window: sliding", matches are also counted into a ring of
+    # per-second buckets (see check_sliding()).
+    self.sliding = (actions.get('window') == 'sliding' and self.period > 0)
+
+    if(self.sliding == True):
+      self.ring = [ 0 ] * self.period
+      self.ring_second = int(time.time())
+      self.ring_count = 0
+      self.next_alert = 0
+
+    # Statistics: lines checked, lines matched, and time spent matching.
+    self.lines = 0
+    self.matched = 0
+    self.match_time = 0.0
+
+    self.metric = 0
+
+    if('metric' in actions):
+      self.metric = int(actions['metric'])
+
+    if('active' in actions):
+      self.active = actions['active']
+
+    attach_consumer(self)
+
+
+
+  # Logs when a file consumer is closed down - this happens when
+  # an aa436.py Agent receives a Reset command from the ax436.py Server.
+
+  def __del__(self):
+    logger.info('Removing file consumer for file '+self.filename)
+
+
+
+  # Checks to see if any of the "periodic" file events
+  # need to be raised.  Examples of periodic events for files are:
+  # - A count of the number of matches of a set of strings within a time period.
+  # - An event raised if no instances of a specified string have appeared in a
+  #   log file within a time period.
+
+  def check_period(self):
+    if(self.sliding == True):
+      self.check_sliding()
+
+    elif(self.period > 0):
+      if(time.time() > self.next_report):
+
+        # Alert if matches exceed the threshold.
+        if(self.threshold > 0 and self.count > self.threshold and len(self.message) > 0):
+          self.list = self.list + [ self.tags + '%%' + self.filename + '%%' + self.message ]
+
+        # Alert if no matches within n seconds.
+        elif(self.count == 0 and len(self.message) > 0 and self.threshold == 0):
+          self.list = self.list + [ self.tags + '%%' + self.filename + '%%' + self.message ]
+
+        # Output the count of matches every n seconds.
+        elif(len(self.message) == 0):
+          if(metric_window > 0):
+            add_metric(self.tags, self.filename, self.count)
+
+          else:
+            self.list = self.list + [ self.tags + '%%' + self.filename + '%%' + str(self.count) ]
+
+        self.next_report = time.time() + self.period
+        self.count = 0
+
+
+
+  # A sliding window keeps the number of matches in each of the last
+  # [period] seconds in a ring, plus a running total for the whole ring.
+  # Each second, the oldest bucket's count is taken off the total and the
+  # bucket is reused, so the count for the window is always up to date at
+  # a constant cost.  alert_n: thresholds are checked on every pass (so a
+  # burst is caught wherever it falls), after which no more alerts are
+  # raised for [period] seconds.  alert_count: reports the number of
+  # matches in the window every [period] seconds.
+
+  def check_sliding(self):
+    now = int(time.time())
+
+    if(now - self.ring_second >= self.period):
+      self.ring = [ 0 ] * self.period
+      self.ring_count = 0
+
+    else:
+      for second in range(self.ring_second + 1, now + 1):
+        self.ring_count -= self.ring[second % self.period]
+        self.ring[second % self.period] = 0
+
+    self.ring_second = now
+    self.ring[now % self.period] += self.count
+    self.ring_count += self.count
+    self.count = 0
+
+    if(self.threshold > 0):
+      if(self.ring_count > self.threshold and len(self.message) > 0 and time.time() >= self.next_alert):
+        self.list = self.list + [ self.tags + '%%' + self.filename + '%%' + self.message ]
+        self.next_alert = time.time() + self.period
+
+    elif(len(self.message) == 0 and time.time() > self.next_report):
+      if(metric_window > 0):
+        add_metric(self.tags, self.filename, self.ring_count)
+
+      else:
+        self.list = self.list + [ self.tags + '%%' + self.filename + '%%' + str(self.ring_count) ]
+
+      self.next_report = time.time() + self.period
+
+
+
+
+  # The file_tailer for this consumer's file calls consume() with each
+  # batch of new lines read from the file, and the file's name (which
+  # differs from the consumer's for a glob or folder).  Lines are ignored
+  # outside of the consumer's active time.
+
+  def consume(self, lines, filename = None):
+    if filename is None:
+      filename = self.filename
+
+    if(is_active(self.active) == True):
+      search = self.matcher.search
+      started = time.perf_counter()
+      self.lines += len(lines)
+
+      for nextline in lines:
+        if search(nextline):
+          self.matched += 1
+
+          if(self.period > 0):
+            self.count += 1
+
+          elif(len(self.message) > 0):
+            # Alert every match with a pre-defined message.
+            self.list.append(self.tags + '%%' + filename + '%%' + self.message)
+
+          else:
+            # Alert every match with the actual line matched.
+            self.list.append(self.tags + '%%' + filename + '%%' + nextline.strip())
+
+      self.match_time += time.perf_counter() - started
+
+
+
+
+  # The main program calls read() for each file consumer.  Returns
+  # the list of events raised since the last call if within an active
+  # time, otherwise returns an empty list.
+
+  def read(self):
+    if(is_active(self.active) == True):
+      self.check_period()
+      alerts = self.list
+
+    else:
+      alerts = []
+
+    self.list = []
+
+    return(alerts)
+
+
+
+
+# Returns a file_consumer for a file monitoring group.  When an Agent is
+# reconfigured, [old_consumers] holds the consumers from the previous
+# configuration, by their settings - an identical consumer is re-used (so
+# it's counters and it's tailer's position in the file are kept), rather
+# than a new one being created.
+
+def get_file_consumer(old_consumers, filename, matches, actions, exceeds):
+  signature = repr(( filename, matches, sorted(actions.items()) ))
+
+  if(len(old_consumers.get(signature, [])) > 0):
+    fc = old_consumers[signature].pop(0)
+    attach_consumer(fc)
+
+  else:
+    fc = file_consumer(filename, matches, actions, exceeds)
+    fc.signature = signature
+
+  return(fc)
+
+
+
+# Returns the settings of a process or command rule, without it's state
+# (counts, running command etc.), for comparing configurations.
+
+def rule_signature(rule):
+  return(repr([ ( k, rule[k] ) for k in sorted(rule) if k not in [ 'count', 'error', 'future', 'started', 'process' ] ]))
+
+
+
+
+# This function is called when an aa436.py Agent receives configuation
+# from an ax436.py Agent.  If the Agent is already configured (it's been
+# sent a Reset), the new configuration replaces the old one, but rules
+# which haven't changed are kept as they are: log files carry on being
+# read from where they'd got to, and counts, process check errors and
+# running commands carry on.  Only new or changed rules are set up from
+# scratch, and files which are no longer monitored are closed.
+
+def do_config(conf):
+  global file_consumer_list
+  global file_events
+  global read_budget_bytes
+  global read_budget_lines
+  global metric_window
+  global stats_interval
+  global resume_limit
+  global max_open_files
+  global ps_command
+  global process_list
+  global process_count
+  global cmd_list
+  global file_tailer_hash
+  global file_target_hash
+  global file_watcher
+  global active_schedule_hash
+  global logger
+
+  c_file = ''
+  c_match = []
+  c_active = ''
+  c_window = ''
+  c_process = ''
+
+  logger.info('Configuration received from server')
+
+  old_consumers = {}
+
+  for fc in file_consumer_list:
+    old_consumers.setdefault(fc.signature, []).append(fc)
+
+  old_processes = {}
+
+  for pc_rec in process_list:
+    old_processes.setdefault(rule_signature(pc_rec), []).append(pc_rec)
+
+  old_commands = {}
+
+  for run_cmd in cmd_list:
+    old_commands.setdefault(rule_signature(run_cmd), []).append(run_cmd)
+
+  old_process_matches = [ pc_rec['match'] for pc_rec in process_list ]
+  old_metric_window = metric_window
+
+  for ft in file_tailer_hash.values():
+    ft.consumers = []
+
+  for target in file_target_hash.values():
+    target.consumers = []
+
+  file_consumer_list = []
+  process_list = []
+  cmd_list = []
+  read_budget_bytes = 1048576
+  read_budget_lines = 10000
+  file_events = 'poll'
+  metric_window = 0
+  stats_interval = 0
+  resume_limit = 10485760
+  max_open_files = 256
+  ps_command = []
+
+  for cl in conf.split('%%'):
+    m = re.match('^([a-z_:]+)\s+(.+)\s*$', cl)
+
+    if m:
+      cmd = m.group(1)
+      arg = m.group(2)
+
+      if(cmd == 'file:'):
+        c_file = arg
+
+      elif(cmd == 'match:'):
+        c_match += [ arg ]
+
+      elif(cmd == 'active:'):
+        c_active = arg
+
+      elif(cmd == 'window:'):
+        c_window = arg.strip()
+
+      elif(cmd == 'alert_all:' and len(c_match) > 0 and len(c_file) > 0):
+        am = re.match('^tags=(\S+)\s+message=(.+)\s*$', arg)
+
+        if am:
+          file_consumer_list += [ get_file_consumer(old_consumers, c_file, c_match, { 'tags': am.group(1), 'message': am.group(2), 'active': get_schedule(c_active) }, '') ]
+
+        else:
+          am2 = re.match('^tags=(\S+)\s*$', arg)
+
+          if am2:
+            file_consumer_list += [ get_file_consumer(old_consumers, c_file, c_match, { 'tags': am2.group(1), 'active': get_schedule(c_active) }, '') ]
+
+        c_file = ''
+        c_match = []
+        c_active = ''
+        c_window = ''
+
+      elif(cmd == 'alert_n:' and len(c_match) > 0 and len(c_file) > 0):
+        am = re.match('^tags=(\S+)\s+threshold=(\d+)\s+seconds=(\d+)\s+message=(.+)\s*$', arg)
+
+        if am:
+          file_consumer_list += [ get_file_consumer(old_consumers, c_file, c_match, { 'tags': am.group(1), 'threshold': am.group(2), 'period': am.group(3), 'message': am.group(4), 'window': c_window, 'active': get_schedule(c_active) }, '') ]
+
+        c_file = ''
+        c_match = []
+        c_active = ''
+        c_window = ''
+
+      elif(cmd == 'alert_count:' and len(c_match) > 0 and len(c_file) > 0):
+        am = re.match('^tags=(\S+)\s+seconds=(\d+)\s*$', arg)
+
+        if am:
+          file_consumer_list += [ get_file_consumer(old_consumers, c_file, c_match, { 'tags': am.group(1), 'period': am.group(2), 'metric': '1', 'window': c_window, 'active': get_schedule(c_active) }, '') ]
+
+        c_file = ''
+        c_match = []
+        c_active = ''
+        c_window = ''
+
+      elif(cmd == 'alert_inactive:' and len(c_match) > 0 and len(c_file) > 0):
+        am = re.match('^tags=(\S+)\s+seconds=(\d+)\s+message=(.+)\s*$', arg)
+
+        if am:
+          file_consumer_list += [ get_file_consumer(old_consumers, c_file, c_match, { 'tags': am.group(1), 'period': am.group(2), 'message': am.group(3), 'metric': '2', 'active': get_schedule(c_active) }, '') ]
+
+        c_file = ''
+        c_match = []
+        c_active = ''
+        c_window = ''
+
+      elif(cmd == 'read_budget:'):
+        rb = re.match('^bytes=(\d+)\s+lines=(\d+)\s*$', arg)
+
+        if rb:
+          read_budget_bytes = int(rb.group(1))
+          read_budget_lines = int(rb.group(2))
+          logger.info('Log file read budget: '+str(read_budget_bytes)+' bytes, '+str(read_budget_lines)+' lines')
+
+      elif(cmd == 'max_open_files:'):
+        if(arg.strip().isdigit() and int(arg.strip()) > 0):
+          max_open_files = int(arg.strip())
+          logger.info('Holding at most '+str(max_open_files)+' log files open')
+
+      elif(cmd == 'resume_limit:'):
+        if arg.strip().isdigit():
+          resume_limit = int(arg.strip())
+          logger.info('Log file resume limit: '+str(resume_limit)+' bytes')
+
+      elif(cmd == 'stats_interval:'):
+        if arg.strip().isdigit():
+          stats_interval = int(arg.strip())
+          logger.info('Statistics sent every '+str(stats_interval)+' seconds')
+
+      elif(cmd == 'metric_window:'):
+        if arg.strip().isdigit():
+          metric_window = int(arg.strip())
+          logger.info('Metric window: '+str(metric_window)+' seconds')
+
+      elif(cmd == 'file_events:'):
+        if(arg.strip() in [ 'poll', 'inotify' ]):
+          file_events = arg.strip()
+          logger.info('Log file change detection: '+file_events)
+
+      elif(cmd == 'ps_command:'):
+        ps_command = arg.split()
+        logger.info('Process check command: '+str(ps_command))
+
+      elif(cmd == 'process:'):
+        c_process = arg
+
+      elif(cmd == 'alert_running:' and len(c_process) > 0):
+        pc = re.match('^tags=(\S+)\s+min=(\d+)\s+max=(\d+)\s+message=(.+)\s*$', arg)
+
+        if pc:
+          pc_rec = { 'match': c_process, 'tags': pc.group(1), 'min': int(pc.group(2)), 'max': int(pc.group(3)), 'message': pc.group(4), 'count': 0, 'error': 0, 'active': get_schedule(c_active) }
+          process_list += [ pc_rec ]
+          logger.info('Watching process: '+str(pc_rec))
+
+        c_process = ''
+        c_active = ''
+
+      elif(cmd == 'run:'):
+        cm = re.match('^command=(.+)\s+extract=(.+?)(?:\s+timeout=(\d+))?\s*$', arg)
+
+        if cm:
+          new_cmd_list = { 'command': cm.group(1).strip().split(), 'extract': cm.group(2).strip(), 'timeout': int(cm.group(3) or 30), 'alerts': [], 'future': None }
+          logger.info('Running command: '+str(new_cmd_list))
+          cmd_list.append(new_cmd_list)
+
+        cm = re.match('^builtin=(\S+)(.*)$', arg)
+
+        if(cm and cm.group(1) in builtin_collectors):
+          new_cmd_list = { 'builtin': cm.group(1), 'command': cm.group(2).split(), 'alerts': [], 'future': None }
+          logger.info('Running collector: '+str(new_cmd_list))
+          cmd_list.append(new_cmd_list)
+
+      elif(cmd == 'alert_if:'):
+        cm = re.match('^tags=(\S+)\s+match=(\d+),(\S+)\s+upper_limit=(\d+),([0-9\.]+)\s+message=(.+)\s*$', arg)
+
+        if cm:
+          new_cmd_alist = { 'tags': cm.group(1), 'match_n': int(cm.group(2)), 'match_str': cm.group(3), 'upper_limit_n': int(cm.group(4)), 'upper_limit_v': float(cm.group(5)), 'message': cm.group(6), 'active': get_schedule(c_active) }
+          logger.info('Alerting on command output: '+str(new_cmd_alist))
+          cmd_list[len(cmd_list)-1]['alerts'].append(new_cmd_alist)
+          c_active = ''
+
+        cm = re.match('^tags=(\S+)\s+match=(\d+),(\S+)\s+lower_limit=(\d+),([0-9\.]+)\s+message=(.+)\s*$', arg)
+
+        if cm:
+          new_cmd_alist = { 'tags': cm.group(1), 'match_n': int(cm.group(2)), 'match_str': cm.group(3), 'lower_limit_n': int(cm.group(4)), 'lower_limit_v': float(cm.group(5)), 'message': cm.group(6), 'active': get_schedule(c_active) }
+          logger.info('Alerting on command output: '+str(new_cmd_alist))
+          cmd_list[len(cmd_list)-1]['alerts'].append(new_cmd_alist)
+          c_active = ''
+
+      elif(cmd == 'alert_metric:'):
+        cm = re.match('^tags=(\S+)\s+match=(\d+),(\S+)\s+metric=(\d+)\s*$', arg)
+
+        if cm:
+          new_cmd_alist = { 'tags': cm.group(1), 'match_n': int(cm.group(2)), 'match_str': cm.group(3), 'metric': int(cm.group(4)), 'active': get_schedule(c_active) }
+          logger.info('Publishing on command output: '+str(new_cmd_alist))
+          cmd_list[len(cmd_list)-1]['alerts'].append(new_cmd_alist)
+          c_active = ''
+
+  # Keep the state of process and command rules which haven't changed.
+  for idx in range(len(process_list)):
+    if(len(old_processes.get(rule_signature(process_list[idx]), [])) > 0):
+      process_list[idx] = old_processes[rule_signature(process_list[idx])].pop(0)
+
+  for idx in range(len(cmd_list)):
+    if(len(old_commands.get(rule_signature(cmd_list[idx]), [])) > 0):
+      cmd_list[idx] = old_commands[rule_signature(cmd_list[idx])].pop(0)
+
+  if(old_process_matches != [ pc_rec['match'] for pc_rec in process_list ]):
+    process_count = None
+
+  # Queue anything raised by consumers which have been dropped, find the
+  # files for globs and folders, and close the files which are no longer
+  # monitored.
+  for fcl in old_consumers.values():
+    for fc in fcl:
+      for alert in fc.list:
+        queue_alert(alert)
+
+  for pattern in [ p for p in file_target_hash if len(file_target_hash[p].consumers) == 0 ]:
+    if file_watcher is not None:
+      file_watcher.remove_target(file_target_hash[pattern])
+
+    logger.info('Removing file target for '+pattern)
+    del file_target_hash[pattern]
+
+  for target in file_target_hash.values():
+    target.discover()
+
+  for filename in [ f for f in file_tailer_hash if len(file_tailer_hash[f].consumers) == 0 ]:
+    if file_watcher is not None:
+      file_watcher.remove(file_tailer_hash[filename])
+
+    file_tailer_hash.pop(filename).close()
+
+  if(metric_window != old_metric_window):
+    flush_metrics(True)
+
+  tailer_pool.trim()
+
+  # Drop saved positions for files which are no longer followed.
+  for filename in [ f for f in file_offsets if f not in file_tailer_hash ]:
+    del file_offsets[filename]
+
+  # Drop the "active:" schedules which are no longer used by any rule.
+  schedules = [ fc.active for fc in file_consumer_list ] + [ pc_rec['active'] for pc_rec in process_list ] + [ run_alist['active'] for run_cmd in cmd_list for run_alist in run_cmd['alerts'] ]
+  active_schedule_hash = dict([ ( sc.active_string, sc ) for sc in schedules ])
+
+  if(file_events == 'poll' and file_watcher is not None):
+    file_watcher.close()
+    file_watcher = None
+
+  watch_files()
+
+
+
+
+
+# Built-in collectors, which can be used with "run: builtin=[name]" in
+# place of a command.  Each returns a list of rows of fields, numbered in
+# the same way as the groups of a command's "extract=" pattern, so that
+# "alert_if:" and "alert_metric:" directives work in the same way:
+# - loadavg: one row - 1: "load", 2-4: 1, 5 and 15 minute load averages.
+# - fs [mount ...]: a row per filesystem (by default, each mounted device
+#   in /proc/mounts, or / if there is no /proc/mounts) - 1: percentage of
+#   space used, 2: percentage of inodes used, 3: mount point, 4: bytes
+#   free, 5: inodes free (the first three match "df -i" on Mac OS X).
+# - meminfo: a row per line of /proc/meminfo - 1: field name (eg.
+#   "MemAvailable"), 2: value (in kB, for sizes).
+
+def collect_loadavg(args):
+  la = os.getloadavg()
+
+  return([ ( 'load', 'load', str(la[0]), str(la[1]), str(la[2]) ) ])
+
+
+
+def collect_fs(args):
+  mounts = args
+
+  if(len(mounts) == 0):
+    try:
+      mf = open('/proc/mounts')
+      mounts = [ ml.split()[1].replace('\\040', ' ') for ml in mf if ml.startswith('/') ]
+      mf.close()
+
+    except OSError:
+      mounts = [ '/' ]
+
+  rows = []
+
+  for mp in mounts:
+    try:
+      st = os.statvfs(mp)
+
+    except OSError:
+      st = None
+
+    if st is not None:
+      used = st.f_blocks - st.f_bfree
+      space = (100.0 * used / (used + st.f_bavail)) if (used + st.f_bavail) > 0 else 0.0
+      inodes = (100.0 * (st.f_files - st.f_ffree) / st.f_files) if st.f_files > 0 else 0.0
+      rows.append(( mp, '{0:.1f}'.format(space), '{0:.1f}'.format(inodes), mp, str(st.f_bavail * st.f_frsize), str(st.f_favail) ))
+
+  return(rows)
+
+
+
+def collect_meminfo(args):
+  rows = []
+  mf = open('/proc/meminfo')
+
+  for ml in mf:
+    mm = re.match('^(\S+):\s+(\d+)', ml)
+
+    if mm:
+      rows.append(( mm.group(1), mm.group(1), mm.group(2) ))
+
+  mf.close()
+
+  return(rows)
+
+
+
+builtin_collectors = { 'loadavg': collect_loadavg, 'fs': collect_fs, 'meminfo': collect_meminfo }
+
+
+
+
+# Runs a "run:" command (or built-in collector) on one of the threads of
+# run_pool.  Returns a list of rows - for a command, a row per output line
+# matched by it's "extract=" pattern, holding the whole match followed by
+# the pattern's groups.  Commands which don't finish within their timeout
+# are killed (along with anything they started), and TimeoutExpired is
+# raised straight away - the killed command is left in
+# run_cmd['process'] for the main loop to reap once it has exited, so a
+# command which is slow to die can't hold on to a run_pool thread.
+# Output from commands which fail is still used.
+
+def run_command(run_cmd):
+  if('builtin' in run_cmd):
+    return(builtin_collectors[run_cmd['builtin']](run_cmd['command']))
+
+  proc = subprocess.Popen(run_cmd['command'], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, start_new_session = True)
+  run_cmd['process'] = proc
+
+  try:
+    output = proc.communicate(timeout = run_cmd['timeout'])[0].decode('utf-8', 'replace')
+
+  except subprocess.TimeoutExpired:
+    try:
+      os.killpg(proc.pid, signal.SIGKILL)
+
+    except OSError:
+      pass
+
+    raise
+
+  rows = []
+
+  for cmd_output_line in output.split('\n'):
+    c_ext = re.search(run_cmd['extract'], cmd_output_line)
+
+    if c_ext:
+      rows.append(( c_ext.group(0), ) + c_ext.groups())
+
+  return(rows)
+
+
+
+
+# Checks the rows returned by a "run:" command against it's "alert_if:"
+# and "alert_metric:" directives.
+
+def check_command_rows(run_cmd, rows):
+  for c_ext in rows:
+    for run_alist in run_cmd['alerts']:
+      if('upper_limit_n' in run_alist and is_active(run_alist['active'])):
+        if(run_alist['match_str'] == c_ext[run_alist['match_n']] and float(c_ext[run_alist['upper_limit_n']]) > run_alist['upper_limit_v']):
+          queue_alert(run_alist['tags']+'%%NULL%%'+run_alist['message'])
+
+      elif('lower_limit_n' in run_alist and is_active(run_alist['active'])):
+        if(run_alist['match_str'] == c_ext[run_alist['match_n']] and float(c_ext[run_alist['lower_limit_n']]) < run_alist['lower_limit_v']):
+          queue_alert(run_alist['tags']+'%%NULL%%'+run_alist['message'])
+
+      elif('metric' in run_alist and is_active(run_alist['active'])):
+        if(run_alist['match_str'] == c_ext[run_alist['match_n']]):
+          if(metric_window > 0 and re.match('^-?[0-9]+(\.[0-9]+)?$', str(c_ext[run_alist['metric']]))):
+            add_metric(run_alist['tags'], 'NULL', float(c_ext[run_alist['metric']]))
+
+          else:
+            queue_alert(run_alist['tags']+'%%NULL%%'+str(c_ext[run_alist['metric']]))
+
+
+
+
+# With a "metric_window:", metrics (from alert_metric: and alert_count:) are
+# not sent as they're produced.  Instead, the count, sum, min and max of
+# each series (tags and file) are kept, and once per window a single
+# summary event is sent for each series:
+#   tags%%file%%count=N sum=S min=A max=B
+
+def add_metric(tags, filename, value):
+  global metric_hash
+
+  key = tags+'%%'+filename
+
+  if(key in metric_hash):
+    mv = metric_hash[key]
+    mv[0] += 1
+    mv[1] += value
+    mv[2] = min(mv[2], value)
+    mv[3] = max(mv[3], value)
+
+  else:
+    metric_hash[key] = [ 1, value, value, value ]
+
+
+
+def format_metric(value):
+  return('{0:.12g}'.format(value))
+
+
+
+# Queues a summary for each metric series once per window (or straight
+# away if [force] is set).
+
+def flush_metrics(force):
+  global metric_hash
+  global next_metric_flush
+
+  if(force == True or time.time() >= next_metric_flush):
+    for key in metric_hash:
+      mv = metric_hash[key]
+      queue_alert(key+'%%count='+str(mv[0])+' sum='+format_metric(mv[1])+' min='+format_metric(mv[2])+' max='+format_metric(mv[3]))
+
+    metric_hash = {}
+    next_metric_flush = time.time() + metric_window
+
+
+
+
+# This function erases all current configuration, closing all log files.
+# (A Reset from the ax436.py Server no longer does this - the new
+# configuration is applied over the current one by do_config().)
+
+def do_unconfig():
+  global logger
+  global file_consumer_list
+  global file_tailer_hash
+  global read_budget_bytes
+  global read_budget_lines
+  global file_events
+  global file_watcher
+  global active_schedule_hash
+  global metric_window
+  global stats_interval
+  global resume_limit
+  global max_open_files
+  global file_target_hash
+  global ps_command
+  global process_list
+  global process_count
+  global cmd_list
+
+  logger.info('Unconfiguring')
+
+  # Send anything aggregated so far, rather than losing it.
+  flush_metrics(True)
+
+  # Remember where each file had been read to, so reading carries on
+  # from there once the Agent is configured again.
+  for ft in file_tailer_hash.values():
+    if ft.position() is not None:
+      file_offsets[ft.filename] = ft.position()
+
+    ft.close()
+
+  if file_watcher is not None:
+    file_watcher.close()
+    file_watcher = None
+
+  file_consumer_list = []
+  file_tailer_hash = {}
+  file_target_hash = {}
+  read_budget_bytes = 1048576
+  read_budget_lines = 10000
+  file_events = 'poll'
+  active_schedule_hash = {}
+  metric_window = 0
+  stats_interval = 0
+  resume_limit = 10485760
+  max_open_files = 256
+  ps_command = []
+  process_list = []
+  process_count = None
+  cmd_list = []
+
+
+
+
+
+# An alert_spool keeps queued alerts in an append-only file in the Agent's
+# state folder, so that they survive the Agent being restarted and so that
+# hours of alerts can be buffered while no Server is reachable without the
+# Agent growing in memory.  Only the alerts at the head of the spool (up to
+# [spool_memory] of them) are held in the in-memory alert queue - the rest
+# are read back from the file in segments as alerts are acknowledged.
+#
+# The offset of the first unacknowledged alert (and the spool file's inode)
+# is saved in a ".head" file.  Once enough of the spool has been
+# acknowledged, the unacknowledged remainder is copied to a fresh file.
+
+class alert_spool:
+  def __init__(self, folder):
+    global logger
+
+    self.filename = os.path.join(folder, 'aa436.spool')
+    self.head_filename = self.filename + '.head'
+    self.open_files()
+    self.head = 0
+
+    try:
+      hf = open(self.head_filename)
+      h_inode, h_offset = hf.read().split()
+      hf.close()
+
+      if(int(h_inode) == self.inode and int(h_offset) <= self.size):
+        self.head = int(h_offset)
+
+    except Exception:
+      pass
+
+    self.saved_head = self.head
+    self.next_save = 0
+    self.read_offset = self.head
+    self.loaded = []
+    self.acked = set()
+    self.compact_file = None
+
+    logger.info('Spooling alerts to '+self.filename+' ('+str(self.size - self.head)+' bytes waiting)')
+
+
+
+  def open_files(self):
+    self.fd = open(self.filename, 'ab', buffering = 0)
+    self.rfd = open(self.filename, 'rb', buffering = 0)
+    st = os.fstat(self.fd.fileno())
+    self.inode = st.st_ino
+    self.size = st.st_size
+
+
+
+  # Appends an alert to the spool.  If all spooled alerts are already in
+  # memory and there is room, the alert goes straight onto the queue too.
+  # Alerts are cut to [spool_alert_size] characters, so every record fits
+  # in a segment.  Returns False if the spool is full.
+
+  def push(self, queue, uid, epoch, alert):
+    alert = alert.replace('\n', ' ')[:spool_alert_size]
+    record = (uid+'%%'+str(epoch)+'%%'+alert+'\n').encode()
+
+    if(self.size + len(record) > spool_max_size):
+      return(False)
+
+    self.fd.write(record)
+
+    if(self.read_offset == self.size and len(queue) < spool_memory):
+      queue.append([ uid, alert, 0, epoch ])
+      self.loaded.append([ self.size + len(record), uid ])
+      self.read_offset += len(record)
+
+    self.size += len(record)
 
-  return(actv)
+    return(True)
 
 
 
-# An instance of file_consumer is created for each file
-# tracking configuration.
+  # Tops up the in-memory alert queue from the spool file.  A record
+  # longer than a segment (only possible in a spool written before alerts
+  # were cut to [spool_alert_size]) is skipped.
 
-class file_consumer:
-  def __init__(self, filename, matches, actions, exceeds):
+  def fill(self, queue):
     global logger
 
-    self.open = False
-    self.filename = filename
-    self.seek = 2
-    self.matches = matches
-    self.tags = actions['tags']
-    self.message = ''
-    self.active = ''
+    while(len(queue) < spool_memory and self.read_offset < self.size):
+      self.rfd.seek(self.read_offset)
+      segment = self.rfd.read(spool_segment_size)
+      eol = segment.rfind(b'\n')
 
-    logger.info('Creating file consumer for file '+filename+' (patterns: '+str(matches)+', '+str(actions)+')')
+      if(eol < 0):
+        end = self.find_eol(self.read_offset + len(segment))
 
-    if('message' in actions):
-      self.message = actions['message']
+        if end is None:
+          break
 
-    self.period = 0
+        logger.error('Error: Skipping spooled alert of '+str(end - self.read_offset)+' bytes (too long)')
+        self.loaded.append([ end, None ])
+        self.read_offset = end
 
-    if('period' in actions):
-      self.period = int(actions['period'])
+      else:
+        pos = 0
 
-    self.threshold = 0
+        for line in segment[:eol].split(b'\n'):
+          if(len(queue) >= spool_memory):
+            break
 
-    if('threshold' in actions):
-      self.threshold = int(actions['threshold'])
+          pos += len(line) + 1
+          rec = line.decode('utf-8', 'replace').split('%%', 2)
 
-    self.count = 0
-    self.next_report = time.time() + self.period
+          if(len(rec) == 3 and rec[1].isdigit()):
+            queue.append([ rec[0], rec[2], 0, int(rec[1]) ])
+            self.loaded.append([ self.read_offset + pos, rec[0] ])
 
-    self.metric = 0
+          else:
+            self.loaded.append([ self.read_offset + pos, None ])
 
-    if('metric' in actions):
-      self.metric = int(actions['metric'])
+        self.read_offset += pos
 
-    if('active' in actions):
-      self.active = actions['active']
 
 
+  # Returns the offset just past the next newline at or after [offset],
+  # or None if there isn't one.
 
-  # Logs when a file consumer is closed down - this happens when
-  # an aa436.py Agent receives a Reset command from the ax436.py Server.
+  def find_eol(self, offset):
+    self.rfd.seek(offset)
 
-  def __del__(self):
-    self.fd.close()
-    logger.info('Removing file consumer for file '+self.filename)
+    while(True):
+      chunk = self.rfd.read(spool_segment_size)
 
+      if not chunk:
+        return(None)
 
+      eol = chunk.find(b'\n')
 
-  # Checks to see if any of the "periodic" file events
-  # need to be raised.  Examples of periodic events for files are:
-  # - A count of the number of matches of a set of strings within a time period.
-  # - An event raised if no instances of a specified string have appeared in a
-  #   log file within a time period.
+      if(eol >= 0):
+        return(offset + eol + 1)
 
-  def check_period(self):
-    if(self.period > 0):
-      if(time.time() > self.next_report):
+      offset += len(chunk)
 
-        # Alert if matches exceed the threshold.
-        if(self.threshold > 0 and self.count > self.threshold and len(self.message) > 0):
-          self.list = self.list + [ self.tags + '%%' + self.filename + '%%' + self.message ]
 
-        # Alert if no matches within n seconds.
-        elif(self.count == 0 and len(self.message) > 0 and self.threshold == 0):
-          self.list = self.list + [ self.tags + '%%' + self.filename + '%%' + self.message ]
 
-        # Output the count of matches every n seconds.
-        elif(len(self.message) == 0):
-          self.list = self.list + [ self.tags + '%%' + self.filename + '%%' + str(self.count) ]
+  # Records acknowledged alerts, moving the head of the spool past any
+  # run of acknowledged alerts at the front.
 
-        self.next_report = time.time() + self.period
-        self.count = 0
+  def ack(self, uids):
+    self.acked.update(uids)
 
+    while(len(self.loaded) > 0 and (self.loaded[0][1] is None or self.loaded[0][1] in self.acked)):
+      self.head = self.loaded[0][0]
+      self.acked.discard(self.loaded[0][1])
+      del self.loaded[0]
 
+    if(self.compact_file is None and self.head >= spool_compact_size and self.head >= (self.size - self.head)):
+      self.compact_start = self.head
+      self.compact_offset = self.head
+      self.compact_file = open(self.filename + '.tmp', 'wb')
 
 
-  # The main program calls read() for each file tracker.  Returns
-  # a list of events from the do_read() function if within an active
-  # time, otherwise returns an empty list.
 
-  def read(self):
-    if(is_active(self.active) == True):
-      return(self.do_read())
+  # Copies the unacknowledged part of the spool to a new file.  The main
+  # loop calls this every pass, and [spool_compact_step] bytes are copied
+  # each time, so a large spool doesn't hold the main loop up.  Once the
+  # copy has caught up with the end of the spool, it replaces the spool.
 
-    else:
-      return([])
+  def compact(self):
+    global logger
 
+    if self.compact_file is None:
+      return
 
+    self.rfd.seek(self.compact_offset)
+    chunk = self.rfd.read(spool_compact_step)
+    self.compact_file.write(chunk)
+    self.compact_offset += len(chunk)
 
+    if(self.compact_offset >= self.size):
+      self.compact_file.close()
+      self.compact_file = None
+      os.rename(self.filename + '.tmp', self.filename)
+      self.fd.close()
+      self.rfd.close()
+      self.open_files()
 
-  # This function does the actual file reading.  Logic to deal with
-  # log files "rolling" is contained here.
+      logger.info('Compacted alert spool ('+str(self.compact_start)+' bytes removed)')
 
-  def do_read(self):
-    global logger
+      for ld in self.loaded:
+        ld[0] -= self.compact_start
 
-    self.list = []
+      self.read_offset -= self.compact_start
+      self.head -= self.compact_start
+      self.save_head()
 
-    self.check_period()
 
-    self.finished = False
 
-    while(self.finished == False):
-      if(self.open == False):
-        try:
-          self.st = os.stat(self.filename)
-          self.inode = self.st.st_ino
-          self.fd = open(self.filename)
-          self.fd.seek(0, self.seek)
-          self.open = True
-          self.seek = 0
-  
-        except Exception:
-          logger.error('Error: File '+self.filename+' not found')
-          self.finished = True
-  
-      else:
-        self.cp = self.fd.tell()
-        self.nextline = self.fd.readline()
-  
-        if not self.nextline:
-          try:
-            self.st = os.stat(self.filename)
-     
-            if(self.st.st_ino != self.inode):
-              self.fd.close()
-              self.open = False
-            else:
-              self.fd.seek(self.cp)
-              self.finished = True
-  
-          except Exception:
-            logger.error('Error: File '+self.filename+' not found')
-            self.finished = True
-  
-        else:
-          for m in self.matches:
-            if(re.search(m,self.nextline) is not None):
-              if(self.period > 0):
-                self.count += 1
+  # Saves the head offset, if it has changed.  The main loop calls this
+  # every pass, so it is rate-limited to once every [spool_save_interval]
+  # seconds, unless forced.
 
-              elif(len(self.message) > 0):
-                # Alert every match with a pre-defined message.
-                self.list = self.list + [ self.tags + '%%' + self.filename + '%%' + self.message ]
+  def save_head(self, force = True):
+    if(force == True or (self.head != self.saved_head and time.time() > self.next_save)):
+      hf = open(self.head_filename + '.tmp', 'w')
+      hf.write(str(self.inode)+' '+str(self.head)+'\n')
+      hf.close()
+      os.rename(self.head_filename + '.tmp', self.head_filename)
+      self.saved_head = self.head
+      self.next_save = time.time() + spool_save_interval
 
-              else:
-                # Alert every match with the actual line matched.
-                self.list = self.list + [ self.tags + '%%' + self.filename + '%%' + self.nextline.strip() ]
 
-    return(self.list)
 
 
+# This function is called to add a new alert to the alert queue.
+# Alerts are sent to the ax436.py Server in batches (see send_alerts()),
+# and stay on the queue until they have been acknowledged.  If the Agent
+# has a state folder, alerts are queued via the spool.
 
+def queue_alert(alert):
+  global uid_seed
+  global alert_queue
+  global spool
+  global logger
 
-# This function is called when an aa436.py Agent first receives configuation
-# from an ax436.py Agent.
+  uid = '{0}_{1}'.format(int(time.time()), uid_seed)
 
-def do_config(conf):
-  global file_consumer_list
-  global ps_command
-  global process_list
-  global cmd_list
-  global logger
+  if spool is not None:
+    queued = spool.push(alert_queue, uid, int(time.time()), alert)
 
-  c_file = ''
-  c_match = []
-  c_active = ''
-  c_process = ''
+  elif(len(alert_queue) < spool_memory):
+    alert_queue += [ [ uid, alert, 0, int(time.time()) ] ]
+    queued = True
 
-  logger.info('Configuration received from server')
+  else:
+    queued = False
 
-  for cl in conf.split('%%'):
-    m = re.match('^([a-z_:]+)\s+(.+)\s*$', cl)
+  if(queued == True):
+    logger.info(time.ctime()+' Queueing: '+alert)
+    uid_seed += 1
+    stats.count('events_queued')
 
-    if m:
-      cmd = m.group(1)
-      arg = m.group(2)
+  else:
+    logger.info(time.ctime()+' Alert not queued (queue full): '+alert)
+    stats.count('events_dropped')
 
-      if(cmd == 'file:'):
-        c_file = arg
 
-      elif(cmd == 'match:'):
-        c_match += [ arg ]
 
-      elif(cmd == 'active:'):
-        c_active = arg
 
-      elif(cmd == 'alert_all:' and len(c_match) > 0 and len(c_file) > 0):
-        am = re.match('^tags=(\S+)\s+message=(.+)\s*$', arg)
+# Sends queued alerts to the ax436.py Server.  Up to [alert_window] alerts
+# at the head of the queue can be awaiting acknowledgement at once.  Alerts
+# which are due to be sent (or re-sent, if they haven't been acknowledged
+# within [alert_retry_interval] seconds) are packed, one per line, into
+# ALERTS datagrams of up to [alert_datagram_size] bytes.  Returns True if
+# anything was sent.
 
-        if am:
-          file_consumer_list += [ file_consumer(c_file, c_match, { 'tags': am.group(1), 'message': am.group(2), 'active': c_active }, '') ]
+def send_alerts(sock, server_addr):
+  global alert_queue
+  global host_name
 
-        else:
-          am2 = re.match('^tags=(\S+)\s*$', arg)
+  now = int(time.time())
+  header = ('ALERTS%%'+host_name).encode()
+  batch = header
+  sent = False
 
-          if am2:
-            file_consumer_list += [ file_consumer(c_file, c_match, { 'tags': am2.group(1), 'active': c_active }, '') ]
+  for queued in alert_queue[:alert_window]:
+    if(now > queued[2]):
+      record = ('\n'+queued[0]+'%%'+str(queued[3])+'%%'+queued[1]).encode()
 
-        c_file = ''
-        c_match = []
-        c_active = ''
+      if(len(batch) > len(header) and len(batch) + len(record) > alert_datagram_size):
+        sock.sendto(batch, server_addr)
+        stats.count('datagrams_sent')
+        batch = header
 
-      elif(cmd == 'alert_n:' and len(c_match) > 0 and len(c_file) > 0):
-        am = re.match('^tags=(\S+)\s+threshold=(\d+)\s+seconds=(\d+)\s+message=(.+)\s*$', arg)
+      batch += record
+      queued[2] = now + alert_retry_interval
+      sent = True
 
-        if am:
-          file_consumer_list += [ file_consumer(c_file, c_match, { 'tags': am.group(1), 'threshold': am.group(2), 'period': am.group(3), 'message': am.group(4), 'active': c_active }, '') ]
+  if(len(batch) > len(header)):
+    sock.sendto(batch, server_addr)
+    stats.count('datagrams_sent')
 
-        c_file = ''
-        c_match = []
-        c_active = ''
+  return(sent)
 
-      elif(cmd == 'alert_count:' and len(c_match) > 0 and len(c_file) > 0):
-        am = re.match('^tags=(\S+)\s+seconds=(\d+)\s*$', arg)
 
-        if am:
-          file_consumer_list += [ file_consumer(c_file, c_match, { 'tags': am.group(1), 'period': am.group(2), 'metric': '1', 'active': c_active }, '') ]
 
-        c_file = ''
-        c_match = []
-        c_active = ''
 
-      elif(cmd == 'alert_inactive:' and len(c_match) > 0 and len(c_file) > 0):
-        am = re.match('^tags=(\S+)\s+seconds=(\d+)\s+message=(.+)\s*$', arg)
+# Removes acknowledged alerts from the alert queue.  The ax436.py Server
+# acknowledges each ALERTS datagram with a list of the alert ids it
+# received.
 
-        if am:
-          file_consumer_list += [ file_consumer(c_file, c_match, { 'tags': am.group(1), 'period': am.group(2), 'message': am.group(3), 'metric': '2', 'active': c_active }, '') ]
+def ack_alerts(uids):
+  global alert_queue
+  global spool
 
-        c_file = ''
-        c_match = []
-        c_active = ''
+  acked = set(uids)
+  remaining = [ queued for queued in alert_queue if queued[0] not in acked ]
 
-      elif(cmd == 'ps_command:'):
-        ps_command = arg.split()
-        logger.info('Process check command: '+str(ps_command))
+  if spool is not None and len(remaining) < len(alert_queue):
+    spool.ack([ queued[0] for queued in alert_queue if queued[0] in acked ])
+    spool.fill(remaining)
 
-      elif(cmd == 'process:'):
-        c_process = arg
+  stats.count('events_acked', len(alert_queue) - len(remaining))
+  alert_queue = remaining
 
-      elif(cmd == 'alert_running:' and len(c_process) > 0):
-        pc = re.match('^tags=(\S+)\s+min=(\d+)\s+max=(\d+)\s+message=(.+)\s*$', arg)
 
-        if pc:
-          pc_rec = { 'match': c_process, 'tags': pc.group(1), 'min': int(pc.group(2)), 'max': int(pc.group(3)), 'message': pc.group(4), 'count': 0, 'error': 0, 'active': c_active }
-          process_list += [ pc_rec ]
-          logger.info('Watching process: '+str(pc_rec))
 
-        c_process = ''
-        c_active = ''
 
-      elif(cmd == 'run:'):
-        cm = re.match('^command=(.+)\s+extract=(.+)\s*$', arg)
+# Returns the Agent's statistics as text (see stats_collector), followed
+# by the statistics of each file consumer.
 
-        if cm:
-          new_cmd_list = { 'command': cm.group(1).strip().split(), 'extract': cm.group(2).strip(), 'alerts': [] }
-          logger.info('Running command: '+str(new_cmd_list))
-          cmd_list.append(new_cmd_list)
+def stats_report():
+  gauges = [ ( 'alert_queue', len(alert_queue) ), ( 'file_tailers', len(file_tailer_hash) ), ( 'open_files', len(tailer_pool.tailers) ), ( 'file_consumers', len(file_consumer_list) ) ]
+  lines = [ stats.report(gauges) ]
 
-      elif(cmd == 'alert_if:'):
-        cm = re.match('^tags=(\S+)\s+match=(\d+),(\S+)\s+upper_limit=(\d+),([0-9\.]+)\s+message=(.+)\s*$', arg)
+  for fc in file_consumer_list:
+    lines.append('consumer '+fc.tags+' '+fc.filename+' lines='+str(fc.lines)+' matched='+str(fc.matched)+' match_seconds='+'{0:.6f}'.format(fc.match_time))
 
-        if cm:
-          new_cmd_alist = { 'tags': cm.group(1), 'match_n': int(cm.group(2)), 'match_str': cm.group(3), 'upper_limit_n': int(cm.group(4)), 'upper_limit_v': float(cm.group(5)), 'message': cm.group(6), 'active': c_active }
-          logger.info('Alerting on command output: '+str(new_cmd_alist))
-          cmd_list[len(cmd_list)-1]['alerts'].append(new_cmd_alist)
-          c_active = ''
+  return('\n'.join(lines))
 
-        cm = re.match('^tags=(\S+)\s+match=(\d+),(\S+)\s+lower_limit=(\d+),([0-9\.]+)\s+message=(.+)\s*$', arg)
 
-        if cm:
-          new_cmd_alist = { 'tags': cm.group(1), 'match_n': int(cm.group(2)), 'match_str': cm.group(3), 'lower_limit_n': int(cm.group(4)), 'lower_limit_v': float(cm.group(5)), 'message': cm.group(6), 'active': c_active }
-          logger.info('Alerting on command output: '+str(new_cmd_alist))
-          cmd_list[len(cmd_list)-1]['alerts'].append(new_cmd_alist)
-          c_active = ''
 
-      elif(cmd == 'alert_metric:'):
-        cm = re.match('^tags=(\S+)\s+match=(\d+),(\S+)\s+metric=(\d+)\s*$', arg)
 
-        if cm:
-          new_cmd_alist = { 'tags': cm.group(1), 'match_n': int(cm.group(2)), 'match_str': cm.group(3), 'metric': int(cm.group(4)), 'active': c_active }
-          logger.info('Publishing on command output: '+str(new_cmd_alist))
-          cmd_list[len(cmd_list)-1]['alerts'].append(new_cmd_alist)
-          c_active = ''
+# Large configurations are sent by the ax436.py Server as a set of
+# CONFIGF fragments (each "CONFIGF%%version%%index%%count%%data"), where
+# the data is a slice of the zlib-compressed, base64-encoded CONFIG
+# message.  A config_fragments instance reassembles them.  If fragments
+# stop arriving before the set is complete, the main loop asks the Server
+# to re-send the missing ones (CONFRESEND).
 
+class config_fragments:
+  def __init__(self):
+    self.clear()
 
 
 
+  def clear(self):
+    self.version = ''
+    self.count = 0
+    self.fragments = {}
+    self.last_seen = 0
+    self.resends = 0
 
-# This function is called to erase all current configuration if the aa436.py Agent is
-# sent a Reset command by the ax436.py Server.
 
-def do_unconfig():
-  global logger
-  global file_consumer_list
-  global ps_command
-  global process_list
-  global cmd_list
 
-  logger.info('Unconfiguring')
+  # Adds a fragment.  Returns the reassembled CONFIG message once all of
+  # the fragments have arrived, otherwise None.
 
-  file_consumer_list = []
-  ps_command = []
-  process_list = []
-  cmd_list = []
+  def add(self, arg):
+    global logger
 
+    fm = re.match('^(\w+)%%(\d+)%%(\d+)%%(.+)$', arg)
 
+    if fm:
+      if(fm.group(1) != self.version):
+        self.clear()
+        self.version = fm.group(1)
+        self.count = int(fm.group(3))
 
+      self.fragments[int(fm.group(2))] = fm.group(4)
+      self.last_seen = time.time()
 
+      if(len(self.fragments) == self.count):
+        data = ''.join([ self.fragments[i] for i in range(self.count) ])
+        self.clear()
 
-# This function is called to add a new alert to the alert queue.
-# Alerts are sent to the ax436.py Server one by one.  Each has
-# to be acknowleged before the next is sent.
+        try:
+          return(zlib.decompress(base64.b64decode(data)).decode())
 
-def queue_alert(alert):
-  global uid_seed
-  global alert_queue
-  global logger
+        except Exception:
+          logger.error('Error: Unable to reassemble configuration')
 
-  if(len(alert_queue) < 256):
-    logger.info(time.ctime()+' Queueing: '+alert)
+    return(None)
 
-    uid = '{0}_{1}'.format(int(time.time()), uid_seed)
-    uid_seed += 1
-    alert_queue += [ [ uid, alert, 0, int(time.time()) ] ]
 
-  else:
-    logger.info(time.ctime()+' Alert not queued (queue full): '+alert)
+
+  # Returns a list of the fragments still to arrive.
+
+  def missing(self):
+    return([ str(i) for i in range(self.count) if i not in self.fragments ])
 
 
 
@@ -436,12 +2179,19 @@ def queue_alert(alert):
 # a loop is entered which invokes log file checks, process checks etc.
 # as well as receiving commands from the ax436.py Server.
 
-def main(port):
+def main(port, state_folder):
   global process_list
+  global process_count
+  global run_pool
   global alert_queue
+  global spool
   global logger
   global host_name
   global cmd_list
+  global killed_commands
+  global file_tailer_hash
+  global file_watcher
+  global stats_interval
 
   logger.setLevel(logging.DEBUG)
   logger.addHandler(logging.handlers.RotatingFileHandler('aa436.log', maxBytes = 1000000, backupCount = 4))
@@ -458,21 +2208,79 @@ def main(port):
   last_update = time.time()
   idle_time = 67
   alert_queue = []
+
+  if(len(state_folder) > 0):
+    spool = alert_spool(state_folder)
+    spool.fill(alert_queue)
+    load_offsets(state_folder)
+
+  # Log file positions are saved every [offset_save_interval] seconds.
+  offset_save_interval = 10
+  next_offset_save = time.time() + offset_save_interval
+
   process_check_interval = 20
   next_process_check = int(time.time()) + process_check_interval
   stats_check_interval = 60
   next_stats_check = int(time.time()) + stats_check_interval
+  killed_command_timeout = 60
   last_process_event = 0
 
+  # When log files are watched using inotify, all files are still checked
+  # every [file_poll_interval] seconds in case any events are missed.
+  file_poll_interval = 60
+  next_file_poll = time.time() + file_poll_interval
+
+  # Globs and folders given to "file:" are checked for new files every
+  # [file_discover_interval] seconds (or when inotify reports a change).
+  file_discover_interval = 10
+  next_file_discover = time.time() + file_discover_interval
+
   addr = ('', port)
   ad_sock = socket(AF_INET, SOCK_DGRAM)
   ad_sock.bind(addr)
 
+  # Statistics are available to local programs on Agent port + 2.
+  try:
+    stats_sock = socket(AF_INET, SOCK_DGRAM)
+    stats_sock.bind(('127.0.0.1', port + 2))
+
+  except OSError as e:
+    logger.error('Error: Unable to open stats port '+str(port + 2)+': '+str(e))
+    stats_sock = None
+
+  next_stats_send = time.time()
+
   inputs = [ ad_sock ]
   outputs = []
 
+  config_frags = config_fragments()
+  frag_timeout = 2
+
+  # If any log file has more data waiting than could be read within the
+  # read budget, don't wait in select() before reading it again.  The
+  # next pass starts with the [next_tailer] file.
+  backlog = False
+  next_tailer = None
+
   while(True):
-    readable, writable, exceptional = select.select(inputs, outputs, inputs, 1.0)
+    inputs = [ ad_sock ]
+
+    if file_watcher is not None:
+      inputs.append(file_watcher)
+
+    if stats_sock is not None:
+      inputs.append(stats_sock)
+
+    readable, writable, exceptional = select.select(inputs, outputs, inputs, 0 if backlog else 1.0)
+    loop_started = time.perf_counter()
+
+    if(file_watcher is not None and file_watcher in readable):
+      file_watcher.read()
+      readable.remove(file_watcher)
+
+    if(stats_sock is not None and stats_sock in readable):
+      stats436.answer_stats(stats_sock, stats_report)
+      readable.remove(stats_sock)
 
     for rs in readable:
       udp_data = rs.recv(65536)
@@ -490,19 +2298,32 @@ def main(port):
             server_name = arg
             logger.info('Selected server: '+arg)
 
-        elif(cmd == 'CONFIG'):
+        # A configuration is only applied once per request, in case the
+        # Server answers a request more than once.
+        elif(cmd == 'CONFIG' and configured == False):
           do_config(arg)
           configured = True
 
+        elif(cmd == 'CONFIGF' and configured == False):
+          conf = config_frags.add(arg)
+
+          if(conf is not None and conf.startswith('CONFIG%%')):
+            do_config(conf[8:])
+            configured = True
+
+        # On a Reset, the current configuration keeps running until the
+        # new one arrives (see do_config()).
         elif(cmd == 'RESET'):
           if(arg == host_name):
-            do_unconfig()
-            last_config_req = time.time() + 10
+            logger.info('Reset - requesting new configuration')
+            last_config_req = 0
             configured = False
 
+        elif(cmd == 'ACKS'):
+          ack_alerts(arg.split(','))
+
         elif(cmd == 'ACK'):
-          if(arg == alert_queue[0][0]):
-            del alert_queue[0]
+          ack_alerts([ arg ])
 
     if(server_seen > 0 and time.time() > (server_seen + server_seen_timeout)):
       logger.info('Deselected server: '+server_name)
@@ -511,30 +2332,105 @@ def main(port):
 
     if(configured == False and len(server_name) > 0 and time.time() > (last_config_req + 10)):
       last_config_req = time.time()
+      config_frags.clear()
       logger.info('Requesting configuration from '+server_name+' on port '+str(port+1))
-      ad_sock.sendto(('CONFREQ%%'+os.uname()[1]).encode(), (server_name, port+1))
+      ad_sock.sendto(('CONFREQ%%'+os.uname()[1]+'%%zfrag').encode(), (server_name, port+1))
       last_update = time.time()
 
+    # Ask for any configuration fragments which haven't arrived within
+    # [frag_timeout] seconds of the last one.
+    if(configured == False and config_frags.count > 0 and config_frags.resends < 5 and time.time() > (config_frags.last_seen + frag_timeout)):
+      logger.info('Requesting missing configuration fragments '+','.join(config_frags.missing()))
+      ad_sock.sendto(('CONFRESEND%%'+os.uname()[1]+'%%'+config_frags.version+'%%'+','.join(config_frags.missing())).encode(), (server_name, port+1))
+      config_frags.last_seen = time.time()
+      config_frags.resends += 1
+
     if(server_seen > 0 and time.time() > (last_update + idle_time) and len(alert_queue) < 3):
       queue_alert('SYSTEM%%NULL%%Idle')
       last_update = time.time()
 
+    backlog = False
+    poll_files = (file_watcher is None or time.time() > next_file_poll)
+
+    # The read budget is shared by all of the files on each pass.  If it
+    # runs out, the files not reached are marked dirty (so they are read
+    # on the next pass), and the next pass starts with the file after the
+    # one which used it up - so files early in the list can't starve the
+    # rest.
+    read_budget = [ read_budget_bytes, read_budget_lines ]
+    tailers = list(file_tailer_hash.values())
+
+    if(next_tailer in file_tailer_hash):
+      t_idx = tailers.index(file_tailer_hash[next_tailer])
+      tailers = tailers[t_idx:] + tailers[:t_idx]
+
+    next_tailer = None
+
+    for t_idx in range(len(tailers)):
+      ft = tailers[t_idx]
+
+      if(poll_files or ft.dirty or ft.backlog or ft.watched == False):
+        lines = ft.read(read_budget)
+
+        if(len(lines) > 0):
+          stats.count('lines_read', len(lines))
+
+          for fc in ft.consumers:
+            fc.consume(lines, ft.filename)
+
+        if(ft.backlog == True):
+          backlog = True
+
+        if(read_budget[0] <= 0 or read_budget[1] <= 0):
+          backlog = True
+
+          for rest in tailers[t_idx + 1:]:
+            if(poll_files or rest.watched == False):
+              rest.dirty = True
+
+          if(t_idx + 1 < len(tailers)):
+            next_tailer = tailers[t_idx + 1].filename
+
+          break
+
+    if(file_watcher is not None and poll_files):
+      for ft in file_tailer_hash.values():
+        if(ft.watched == False):
+          file_watcher.add(ft)
+
+      for target in file_target_hash.values():
+        if(target.watched == False):
+          file_watcher.add_target(target)
+
+      next_file_poll = time.time() + file_poll_interval
+
+    discover_files = (time.time() > next_file_discover)
+
+    for target in list(file_target_hash.values()):
+      if(target.dirty or (discover_files and (file_watcher is None or target.watched == False)) or (file_watcher is not None and poll_files)):
+        target.discover()
+
+    if(discover_files == True):
+      next_file_discover = time.time() + file_discover_interval
+
     for fc in file_consumer_list:
       for alert in fc.read():
         queue_alert(alert)
 
     if(len(ps_command) > 0 and int(time.time()) > next_process_check):
-      ps_output = subprocess.check_output(ps_command)
+      check_started = time.perf_counter()
+
+      if process_count is None:
+        process_count = process_counter([ pc_rec['match'] for pc_rec in process_list ])
 
-      for zeroing_idx in range(len(process_list)):
-        process_list[zeroing_idx]['count'] = 0
+      if(ps_command == [ 'builtin=proc' ]):
+        ps_counts = process_count.count_proc()
 
-      for ps_line in ps_output.decode().split('\n'):
-        for watching_idx in range(len(process_list)):
-          pm = re.search(process_list[watching_idx]['match'], ps_line)
+      else:
+        ps_counts = process_count.count_lines(subprocess.check_output(ps_command).decode().split('\n'))
 
-          if pm:
-            process_list[watching_idx]['count'] += 1
+      for watching_idx in range(len(process_list)):
+        process_list[watching_idx]['count'] = ps_counts[watching_idx]
 
       for checking_idx in range(len(process_list)):
         if(process_list[checking_idx]['count'] < process_list[checking_idx]['min'] or process_list[checking_idx]['count'] > process_list[checking_idx]['max']):
@@ -550,48 +2446,103 @@ def main(port):
           last_process_event = int(time.time())
 
       next_process_check = int(time.time()) + process_check_interval
+      stats.timing('process_check', time.perf_counter() - check_started)
 
+    # "run:" commands are run concurrently on run_pool, so that a slow or
+    # hung command can't hold up the main loop.  A command isn't started
+    # again until it's previous run has finished.
     if(time.time() > next_stats_check):
+      if run_pool is None:
+        run_pool = concurrent.futures.ThreadPoolExecutor(max_workers = run_workers)
+
       for run_cmd in cmd_list:
-        for cmd_output_line in subprocess.check_output(run_cmd['command']).decode().split('\n'):
-          c_ext = re.search(run_cmd['extract'], cmd_output_line)
+        if run_cmd['future'] is None:
+          run_cmd['future'] = run_pool.submit(run_command, run_cmd)
+          run_cmd['started'] = time.time()
+
+      next_stats_check = int(time.time()) + stats_check_interval
 
-          if c_ext:
-            for run_alist in run_cmd['alerts']:
-              if('upper_limit_n' in run_alist and is_active(run_alist['active'])):
-                if(run_alist['match_str'] == c_ext.group(run_alist['match_n']) and float(c_ext.group(run_alist['upper_limit_n'])) > run_alist['upper_limit_v']):
-                  queue_alert(run_alist['tags']+'%%NULL%%'+run_alist['message'])
+    for run_cmd in cmd_list:
+      if(run_cmd['future'] is not None and run_cmd['future'].done()):
+        try:
+          check_command_rows(run_cmd, run_cmd['future'].result())
 
-              elif('lower_limit_n' in run_alist and is_active(run_alist['active'])):
-                if(run_alist['match_str'] == c_ext.group(run_alist['match_n']) and float(c_ext.group(run_alist['lower_limit_n'])) < run_alist['lower_limit_v']):
-                  queue_alert(run_alist['tags']+'%%NULL%%'+run_alist['message'])
+        except subprocess.TimeoutExpired:
+          logger.error('Error: Command '+str(run_cmd['command'])+' timed out (killed pid '+str(run_cmd['process'].pid)+')')
+          killed_commands.append([ run_cmd['process'], run_cmd['command'], time.time(), False ])
 
-              elif('metric' in run_alist and is_active(run_alist['active'])):
-                if(run_alist['match_str'] == c_ext.group(run_alist['match_n'])):
-                  queue_alert(run_alist['tags']+'%%NULL%%'+str(c_ext.group(run_alist['metric'])))
+        except Exception as e:
+          logger.error('Error: Command '+str(run_cmd['command'])+' failed: '+str(e))
 
-      next_stats_check = int(time.time()) + stats_check_interval
+        run_cmd.pop('process', None)
+        run_cmd['future'] = None
+        stats.timing('run_command', time.time() - run_cmd['started'])
+
+    # Reap commands killed after timing out.  A command stuck in the
+    # kernel (eg. on a hung NFS mount) may not exit for some time after
+    # being killed, so it is logged if it's still there after
+    # [killed_command_timeout] seconds.
+    if(len(killed_commands) > 0):
+      still_running = []
+
+      for killed in killed_commands:
+        if killed[0].poll() is None:
+          if(killed[3] == False and time.time() > killed[2] + killed_command_timeout):
+            logger.error('Error: Killed command '+str(killed[1])+' (pid '+str(killed[0].pid)+') has not exited')
+            killed[3] = True
+
+          still_running.append(killed)
+
+        else:
+          killed[0].stdout.close()
+
+          if(killed[3] == True):
+            logger.info('Killed command '+str(killed[1])+' (pid '+str(killed[0].pid)+') has exited')
+
+      killed_commands = still_running
+
+    if(metric_window > 0):
+      flush_metrics(False)
 
     if(last_process_event > 0 and time.time() > (last_process_event + (process_check_interval * 2) + 30)):
       last_process_event = 0
       queue_alert('SYSTEM%%NULL%%Process check: All clear')
 
     if(len(alert_queue) > 0):
-      if(int(time.time()) > alert_queue[0][2]):
-        ad_sock.sendto(('ALERT%%'+host_name+'%%'+alert_queue[0][0]+'%%'+str(alert_queue[0][3])+'%%'+alert_queue[0][1]).encode(), (server_name, port+1))
-        alert_queue[0][2] = int(time.time()) + 10
+      if(send_alerts(ad_sock, (server_name, port+1)) == True):
         last_update = time.time()
 
+    if spool is not None:
+      spool.compact()
+      spool.save_head(False)
+
+    if(len(state_folder) > 0 and time.time() > next_offset_save):
+      save_offsets(state_folder)
+      next_offset_save = time.time() + offset_save_interval
+
+    # Send the Agent's statistics to the Server as SYSTEM metrics.
+    if(stats_interval > 0 and time.time() > next_stats_send):
+      for name, value in stats.interval_metrics() + [ ( 'alert_queue', len(alert_queue) ) ]:
+        queue_alert('SYSTEM%%'+name+'%%'+str(value))
 
+      next_stats_send = time.time() + stats_interval
 
+    stats.timing('main_loop', time.perf_counter() - loop_started)
 
-# Start hook.  The only argument an aa436.py Agent takes is the UDP
-# port to listen for broadcasts from the ax436.py Server on.
+
+
+
+# Start hook.  An aa436.py Agent takes the UDP port to listen for broadcasts
+# from the ax436.py Server on and, optionally, a folder to keep its state
+# (eg. the alert spool) in.
 
 if __name__ == '__main__':
   if len(sys.argv) < 2:
-    print('Usage: aa436.py udp_port')
+    print('Usage: aa436.py udp_port [state_folder]')
     exit(1)
 
+  elif len(sys.argv) < 3:
+    main(int(sys.argv[1]), '')
+
   else:
-    main(int(sys.argv[1]))
+    main(int(sys.argv[1]), sys.argv[2])
@@ -5,7 +5,7 @@
 #   Project 436 Agents (aa436.py) can find it.
 # - Supplying Agents with their configurations, on demand.
 # - Sending Agents "Reset" commands if their configuration files
-#   are updated.
+#   (or the files they include) are updated.
 # - Checking whether configured Agents have supplied a heartbeat
 #   notification back to the Server recently.
 # - Capture and acknowledgement of fault / metric events from
@@ -46,10 +46,1016 @@ import time
 import re
 import select
 import string
+import zlib
+import base64
+import heapq
+import mmap
+import struct
+import collections
+import urllib.parse
 import logging
 import logging.handlers
 from socket import *
 
+import stats436
+
+
+
+
+# Globals:
+# Server configuration, shared by the main loop and the functions which
+# handle messages from Agents.
+
+logger = logging.getLogger(__name__)
+event_writer = None
+event_ack = 'flush'
+port = 0
+host_dir = ''
+include_dir = ''
+scan_hash = {}
+heartbeat_heap = []
+metrics = None
+suppressor = None
+
+# This is the time after which an Agent is considered
+# "dead" if that Agent doesn't send any notifications
+# to the Server.
+max_idle_time = 180
+
+
+
+
+# Reads the index of an Event Stream file, returning a list of
+# [ block, host, tags, first_offset, end_offset ] entries.
+
+event_index_block = 60
+
+def read_event_index(filename):
+  entries = []
+
+  try:
+    with open(filename+'.idx', 'r', errors = 'replace') as f:
+      for line in f:
+        il = line.split()
+
+        if(len(il) == 5 and line.endswith('\n') and il[0].isdigit() and il[3].isdigit() and il[4].isdigit()):
+          entries.append([ int(il[0]), il[1], il[2], int(il[3]), int(il[4]) ])
+
+  except OSError:
+    pass
+
+  return(entries)
+
+
+
+
+# The Server keeps statistics about it's own performance (see
+# stats436.py).  A "STATS" datagram to the Server's stats port (127.0.0.1,
+# Server port + 3) returns them as text.
+
+stats = stats436.stats_collector()
+
+
+
+
+# Returns the Event Stream line for an event: the event, with a time stamp
+# in front of it.  The time stamp is only formatted once per second.
+
+event_ctime_second = 0
+event_ctime_text = ''
+
+def format_event(event):
+  global event_ctime_second
+  global event_ctime_text
+
+  now = int(time.time())
+
+  if(now != event_ctime_second):
+    event_ctime_second = now
+    event_ctime_text = time.ctime(now)
+
+  return((event_ctime_text+'%%'+event+'\n').encode())
+
+
+
+
+# The event_stream_writer writes the Event Stream.  Events are buffered and
+# written in groups, either once [flush_bytes] of events are waiting or
+# [flush_interval] seconds after the first event of the group arrived.
+# The writer rolls the Event Stream itself, keeping [backup_count] old
+# copies (in the same way as a RotatingFileHandler would).
+#
+# Each Event Stream file has an index (the same name, plus ".idx") which
+# is rolled along with it.  As each group is written, a line is added to
+# the index for each block of [event_index_block] seconds (by the time
+# the Agent raised the event), host and tags in the group:
+#   block host tags first_offset end_offset
+# where the offsets are those of the first matching event in the file and
+# the end of the last one.  The index lets qx436.py jump straight to the
+# events of a host / tag / period.
+#
+# Acknowledgements for the events are passed to the writer too, and are
+# sent according to the "event_ack:" policy:
+# - immediate - as soon as events are buffered.
+# - flush     - once events have been written to the Event Stream (default).
+# - fsync     - once events have been written and synced to disk.
+
+class event_stream_writer:
+  def __init__(self, filename, max_bytes, backup_count, flush_bytes, flush_interval, ack_policy):
+    self.filename = filename
+    self.max_bytes = max_bytes
+    self.backup_count = backup_count
+    self.flush_bytes = flush_bytes
+    self.flush_interval = flush_interval
+    self.ack_policy = ack_policy
+    self.buffer = []
+    self.buffer_size = 0
+    self.flush_due = 0
+    self.first_buffered = 0
+    self.pending_acks = []
+    self.open_stream()
+
+
+
+  def open_stream(self):
+    self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    self.size = os.fstat(self.fd).st_size
+    self.index_fd = os.open(self.filename+'.idx', os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    # Index anything written to the Event Stream which isn't in the index
+    # (written by an older Server, or before a crash).
+    indexed = max([ 0 ] + [ e[4] for e in read_event_index(self.filename) ])
+
+    if(indexed > self.size):
+      os.ftruncate(self.index_fd, 0)
+      indexed = 0
+
+    if(indexed < self.size):
+      with open(self.filename, 'rb') as f:
+        f.seek(indexed)
+        lines = f.read(self.size - indexed).splitlines(True)
+
+      if(len(lines) > 0 and not lines[-1].endswith(b'\n')):
+        lines[-1] += b'\n'
+        os.write(self.fd, b'\n')
+        self.size += 1
+
+      self.write_index(lines, indexed)
+
+
+
+  # Adds index lines for a group of events written to the Event Stream at
+  # [offset].
+
+  def write_index(self, lines, offset):
+    index_hash = {}
+
+    for line in lines:
+      ev = line.split(b'%%', 5)
+
+      if(len(ev) == 6 and ev[3].isdigit()):
+        key = ( int(ev[3]) // event_index_block, ev[1], ev[4] )
+
+        if key in index_hash:
+          index_hash[key][1] = offset + len(line)
+
+        else:
+          index_hash[key] = [ offset, offset + len(line) ]
+
+      offset += len(line)
+
+    index_data = [ (str(k[0])+' '+k[1].decode(errors = 'replace')+' '+k[2].decode(errors = 'replace')+' '+str(index_hash[k][0])+' '+str(index_hash[k][1])+'\n').encode() for k in index_hash ]
+
+    if(len(index_data) > 0):
+      os.write(self.index_fd, b''.join(index_data))
+
+
+
+  # Adds an event (without it's time stamp) to the buffer.
+
+  def write(self, event):
+    self.write_line(format_event(event))
+
+
+
+  # Adds an Event Stream line (already formatted by format_event()) to
+  # the buffer.
+
+  def write_line(self, line):
+    if(len(self.buffer) == 0):
+      self.flush_due = time.time() + self.flush_interval
+      self.first_buffered = time.time()
+
+    self.buffer.append(line)
+    self.buffer_size += len(line)
+
+    if(self.buffer_size >= self.flush_bytes):
+      self.flush()
+
+
+
+  # Sends an acknowledgement, or holds it until the events it refers to
+  # are durable.
+
+  def ack(self, sock, message, to_addr):
+    if(self.ack_policy == 'immediate' or (len(self.buffer) == 0 and len(self.pending_acks) == 0)):
+      sock.sendto(message, to_addr)
+
+    else:
+      self.pending_acks.append([ sock, message, to_addr ])
+
+
+
+  # Writes out the buffered events, rolling the Event Stream if it would
+  # grow past [max_bytes], then sends any acknowledgements being held.
+
+  def flush(self):
+    if(len(self.buffer) > 0):
+      lines = self.buffer
+      data = b''.join(lines)
+      self.buffer = []
+      self.buffer_size = 0
+      write_started = time.perf_counter()
+
+      if(self.size > 0 and self.size + len(data) > self.max_bytes):
+        self.rotate()
+
+      os.write(self.fd, data)
+      self.write_index(lines, self.size)
+      self.size += len(data)
+
+      if(self.ack_policy == 'fsync'):
+        os.fsync(self.fd)
+
+      stats.count('events_written', len(lines))
+      stats.count('event_bytes_written', len(data))
+      stats.timing('event_write', time.perf_counter() - write_started)
+      stats.timing('event_buffer_wait', time.time() - self.first_buffered)
+
+    for pa in self.pending_acks:
+      pa[0].sendto(pa[1], pa[2])
+
+    self.pending_acks = []
+
+
+
+  def rotate(self):
+    os.close(self.fd)
+    os.close(self.index_fd)
+
+    for i in range(self.backup_count - 1, 0, -1):
+      if os.path.exists(self.filename+'.'+str(i)):
+        os.replace(self.filename+'.'+str(i), self.filename+'.'+str(i + 1))
+
+      if os.path.exists(self.filename+'.'+str(i)+'.idx'):
+        os.replace(self.filename+'.'+str(i)+'.idx', self.filename+'.'+str(i + 1)+'.idx')
+
+      elif os.path.exists(self.filename+'.'+str(i + 1)+'.idx'):
+        os.remove(self.filename+'.'+str(i + 1)+'.idx')
+
+    os.replace(self.filename, self.filename+'.1')
+    os.replace(self.filename+'.idx', self.filename+'.1.idx')
+    self.open_stream()
+
+
+
+  # Called from the main loop - flushes the buffer if it's been waiting
+  # for [flush_interval] seconds.  Returns how long select() should wait.
+
+  def poll(self, max_wait):
+    if(len(self.buffer) > 0 or len(self.pending_acks) > 0):
+      if(time.time() >= self.flush_due):
+        self.flush()
+
+      else:
+        return(min(max_wait, self.flush_due - time.time()))
+
+    return(max_wait)
+
+
+
+
+# A metric_series holds the values of one metric series (a host, tags and
+# file) in a memory-mapped file.  After a 64 byte header, the file holds
+# three fixed-size rings of (time, count, sum, min, max) records:
+# - raw: the last 4096 values received.
+# - 1m:  per-minute aggregates, for 7 days.
+# - 1h:  per-hour aggregates, for 400 days.
+# The raw ring is written in order (the header holds a count of the values
+# written so far).  The 1m and 1h rings are indexed by time, so each value
+# is added into it's minute and hour as it arrives, and a slot holding an
+# older minute / hour is simply overwritten.
+#
+# A series opened with [read_only] (by the qx436.py Query tool) is mapped
+# read-only, so it only needs read access to the Server's files and can't
+# change a series the Server is writing.
+
+metric_magic = b'MS436\0\0\1'
+metric_header = struct.Struct('<8sQ')
+metric_header_size = 64
+metric_record = struct.Struct('<IIddd')
+metric_tiers = [ ( 'raw', 0, 4096 ), ( '1m', 60, 10080 ), ( '1h', 3600, 9600 ) ]
+
+class metric_series:
+  def __init__(self, filename, create, read_only = False):
+    size = metric_header_size + (sum([ t[2] for t in metric_tiers ]) * metric_record.size)
+
+    if(read_only == True):
+      f = open(filename, 'rb')
+      self.mm = mmap.mmap(f.fileno(), size, access = mmap.ACCESS_READ)
+
+    else:
+      if(create == True and not os.path.exists(filename)):
+        f = open(filename, 'w+b')
+        f.truncate(size)
+        f.write(metric_header.pack(metric_magic, 0))
+
+      else:
+        f = open(filename, 'r+b')
+
+      self.mm = mmap.mmap(f.fileno(), size)
+
+    f.close()
+
+    if(self.mm[0:8] != metric_magic):
+      self.mm.close()
+      raise ValueError('Not a metric series: '+filename)
+
+    self.offsets = []
+    offset = metric_header_size
+
+    for t in metric_tiers:
+      self.offsets.append(offset)
+      offset += t[2] * metric_record.size
+
+
+
+  def close(self):
+    self.mm.close()
+
+
+
+  # Adds a value (or an aggregate of values) to the series.
+
+  def add(self, ts, count, total, vmin, vmax):
+    raw_count = metric_header.unpack_from(self.mm, 0)[1]
+    metric_record.pack_into(self.mm, self.offsets[0] + ((raw_count % metric_tiers[0][2]) * metric_record.size), ts, count, total, vmin, vmax)
+    metric_header.pack_into(self.mm, 0, metric_magic, raw_count + 1)
+
+    for tier in range(1, len(metric_tiers)):
+      step = metric_tiers[tier][1]
+      bucket = ts - (ts % step)
+      pos = self.offsets[tier] + (((ts // step) % metric_tiers[tier][2]) * metric_record.size)
+      b_ts, b_count, b_total, b_min, b_max = metric_record.unpack_from(self.mm, pos)
+
+      if(b_ts == bucket and b_count > 0):
+        metric_record.pack_into(self.mm, pos, bucket, b_count + count, b_total + total, min(b_min, vmin), max(b_max, vmax))
+
+      else:
+        metric_record.pack_into(self.mm, pos, bucket, count, total, vmin, vmax)
+
+
+
+  # Returns the records of a tier ('raw', '1m' or '1h') from t_from to
+  # t_to (inclusive), in time order.
+
+  def query(self, tier_name, t_from, t_to):
+    tier = [ t[0] for t in metric_tiers ].index(tier_name)
+    step = metric_tiers[tier][1]
+    slots = metric_tiers[tier][2]
+    records = []
+
+    if(step == 0):
+      raw_count = metric_header.unpack_from(self.mm, 0)[1]
+
+      for i in range(max(0, raw_count - slots), raw_count):
+        rec = metric_record.unpack_from(self.mm, self.offsets[0] + ((i % slots) * metric_record.size))
+
+        if(rec[0] >= t_from and rec[0] <= t_to):
+          records.append(rec)
+
+      records.sort(key = lambda r: r[0])
+
+    else:
+      for b in range(max(t_from // step, (t_to // step) - slots + 1), (t_to // step) + 1):
+        rec = metric_record.unpack_from(self.mm, self.offsets[tier] + ((b % slots) * metric_record.size))
+
+        if(rec[0] == b * step and rec[1] > 0):
+          records.append(rec)
+
+    return(records)
+
+
+
+  # Returns the time from which the raw ring holds every value (0 if it
+  # has not yet wrapped round).
+
+  def raw_start(self):
+    raw_count = metric_header.unpack_from(self.mm, 0)[1]
+
+    if(raw_count <= metric_tiers[0][2]):
+      return(0)
+
+    return(min([ metric_record.unpack_from(self.mm, self.offsets[0] + (i * metric_record.size))[0] for i in range(min(raw_count, metric_tiers[0][2])) ]))
+
+
+
+
+# The metric_store keeps a metric_series for each series of metrics
+# received from Agents, in the "metric_store:" folder.  Series files are
+# named after the (quoted) host, tags and file.  Up to [max_open] series
+# are kept open (memory-mapped) at once.  A [read_only] store (used by
+# qx436.py) opens series read-only, and never creates anything.
+
+class metric_store:
+  def __init__(self, folder, max_open = 256, read_only = False):
+    self.folder = folder
+    self.max_open = max_open
+    self.read_only = read_only
+    self.series = collections.OrderedDict()
+
+    if(read_only == False and not os.path.isdir(folder)):
+      os.makedirs(folder)
+
+
+
+  def series_file(self, host, tags, filename):
+    return(os.path.join(self.folder, urllib.parse.quote(host+'%%'+tags+'%%'+filename, safe = '')+'.ms'))
+
+
+
+  # Returns the metric_series for a host, tags and file.
+
+  def get(self, host, tags, filename, create = True):
+    key = ( host, tags, filename )
+
+    if(key in self.series):
+      self.series.move_to_end(key)
+
+    else:
+      if(len(self.series) >= self.max_open):
+        self.series.popitem(last = False)[1].close()
+
+      self.series[key] = metric_series(self.series_file(host, tags, filename), create, self.read_only)
+
+    return(self.series[key])
+
+
+
+  def add(self, host, tags, filename, ts, count, total, vmin, vmax):
+    self.get(host, tags, filename).add(ts, count, total, vmin, vmax)
+
+
+
+  # Returns a list of the ( host, tags, file ) series in the store.
+
+  def list_series(self):
+    found = []
+
+    for se in os.scandir(self.folder):
+      if se.name.endswith('.ms'):
+        found.append(tuple(urllib.parse.unquote(se.name[:-3]).split('%%', 2)))
+
+    return(sorted(found))
+
+
+
+
+# Checks whether an event from an Agent is a metric (an event whose message
+# is just a number, or a summary of a metric from an Agent with a
+# "metric_window:" - "count=N sum=S min=A max=B"), and if so, adds it to
+# the metric store.  The event is in the form
+# "host%%uid%%time%%tags%%file%%message".
+
+metric_value = re.compile('^-?[0-9]+(\\.[0-9]+)?$')
+metric_summary = re.compile('^count=([0-9]+) sum=(\\S+) min=(\\S+) max=(\\S+)$')
+
+def record_metric(event):
+  global metrics
+  global logger
+
+  ev = event.split('%%', 5)
+
+  if(len(ev) == 6 and ev[2].isdigit()):
+    try:
+      if metric_value.match(ev[5]):
+        value = float(ev[5])
+        metrics.add(ev[0], ev[3], ev[4], int(ev[2]), 1, value, value, value)
+
+      else:
+        ms = metric_summary.match(ev[5])
+
+        if ms:
+          metrics.add(ev[0], ev[3], ev[4], int(ev[2]), int(ms.group(1)), float(ms.group(2)), float(ms.group(3)), float(ms.group(4)))
+
+    except (OSError, ValueError) as e:
+      logger.info('Error: Unable to store metric: '+str(e))
+
+
+
+
+# The event_suppressor stops a flood of the same event (eg. from a log
+# file looping on an error) from filling the Event Stream.  Events are
+# keyed on their host, tags, file and message (with numbers removed, so
+# that messages differing only in times, ids, counts etc. look the same).
+# Only the first [max_events] events with a key within [seconds] are
+# written.  Further events are still acknowledged (so Agents don't re-send
+# them), but are only counted, and at the end of the period a single
+# "N similar events suppressed" event is written instead.  Metrics and
+# SYSTEM events are never suppressed.
+
+class event_suppressor:
+  def __init__(self, max_events, seconds, max_keys = 100000):
+    self.max_events = max_events
+    self.seconds = seconds
+    self.max_keys = max_keys
+    self.key_hash = {}
+    self.next_sweep = 0
+
+
+
+  # Returns whether an event (in the form
+  # "host%%uid%%time%%tags%%file%%message") should be written.
+
+  def check(self, event):
+    ev = event.split('%%', 5)
+
+    if(len(ev) < 6 or ev[3] == 'SYSTEM' or metric_value.match(ev[5]) or metric_summary.match(ev[5])):
+      return(True)
+
+    key = ( ev[0], ev[3], ev[4], re.sub('[0-9]+', '#', ev[5]) )
+
+    if(key in self.key_hash):
+      entry = self.key_hash[key]
+
+      if(entry[1] < self.max_events):
+        entry[1] += 1
+        return(True)
+
+      entry[2] += 1
+      stats.count('events_suppressed')
+      return(False)
+
+    elif(len(self.key_hash) < self.max_keys):
+      self.key_hash[key] = [ time.time() + self.seconds, 1, 0, ev[5] ]
+
+    return(True)
+
+
+
+  # Called from the main loop - ends the periods which have expired, and
+  # returns a summary event for each period in which events were
+  # suppressed.
+
+  def sweep(self):
+    now = time.time()
+    summaries = []
+
+    if(now >= self.next_sweep):
+      expired = [ key for key in self.key_hash if self.key_hash[key][0] <= now ]
+
+      for key in expired:
+        entry = self.key_hash.pop(key)
+
+        if(entry[2] > 0):
+          summaries.append(key[0]+'%%000000%%'+str(int(now))+'%%'+key[1]+'%%'+key[2]+'%%'+str(entry[2])+' similar events suppressed in '+str(self.seconds)+' seconds: '+entry[3])
+
+      self.next_sweep = now + 1
+
+    return(summaries)
+
+
+
+
+# Splits a CONFIG message which is too large to send in one datagram
+# (more than [frag_size] bytes) into CONFIGF fragments.  The message is
+# compressed and base64-encoded, then each fragment carries a slice of it:
+# "CONFIGF%%version%%index%%count%%data".  The version is a checksum of
+# the message, so that Agents can tell fragments of different
+# configurations apart.  Returns the version and the list of fragments
+# (which is empty for small messages).
+
+frag_size = 1200
+
+def make_fragments(config):
+  version = '{0:08x}'.format(zlib.crc32(config))
+
+  if(len(config) <= frag_size):
+    return(version, [])
+
+  data = base64.b64encode(zlib.compress(config, 9))
+  count = (len(data) + frag_size - 1) // frag_size
+
+  return(version, [ ('CONFIGF%%'+version+'%%'+str(i)+'%%'+str(count)+'%%').encode() + data[i * frag_size:(i + 1) * frag_size] for i in range(count) ])
+
+
+
+
+# Returns the modification time of an include file, or None if it doesn't
+# exist.
+
+def include_mtime(name):
+  try:
+    return(int(os.stat(include_dir+"/"+name).st_mtime))
+
+  except OSError:
+    return(None)
+
+
+
+
+# Reads a host's configuration file (and the files it includes), and
+# caches the rendered CONFIG message in scan_hash along with the
+# modification times of the files it was built from.  The folder scan in
+# main() reloads the cached configuration when any of those files change.
+
+def load_host(sh):
+  global logger
+  global host_dir
+  global include_dir
+  global scan_hash
+  global heartbeat_heap
+
+  if(sh not in scan_hash):
+    scan_hash[sh] = { 'agent_seen': 0, 'mtime': 0, 'alive': True }
+    heapq.heappush(heartbeat_heap, (int(time.time()) + max_idle_time, sh))
+
+  host = scan_hash[sh]
+  host['config'] = None
+  host['fragments'] = []
+  host['includes'] = {}
+  clines = [ 'START' ]
+
+  try:
+    logger.info('Loading host file '+host_dir+"/"+sh)
+
+    host['mtime'] = int(os.stat(host_dir+"/"+sh).st_mtime)
+    cfile = open(host_dir+"/"+sh)
+
+    for c in cfile:
+      inc = re.match('^include:\s+(\S+)\s*$', c)
+
+      if inc:
+        logger.info('Loading include file '+include_dir+"/"+inc.group(1))
+
+        host['includes'][inc.group(1)] = include_mtime(inc.group(1))
+        ifile = open(include_dir+"/"+inc.group(1))
+
+        for i in ifile:
+          clines.append(i.strip())
+
+        ifile.close()
+
+      else:
+        clines.append(c.strip())
+
+    cfile.close()
+
+    host['config'] = ('CONFIG%%'+'%%'.join(clines)).encode()
+    host['version'], host['fragments'] = make_fragments(host['config'])
+
+  except IOError:
+    logger.info('Error: Unable to load configuration for host '+sh)
+
+
+
+
+# Respond to a "Configuration Requested" command from an Agent, using the
+# configuration cached in scan_hash (which is loaded first if the host
+# hasn't been seen by a folder scan yet).  Agents which can reassemble
+# fragmented configurations add "zfrag" to their request - large
+# configurations are sent to them as CONFIGF fragments.
+
+def do_confreq(sock, arg, from_ip):
+  global logger
+  global host_dir
+  global scan_hash
+  global port
+
+  options = arg.split('%%')
+  sh = options[0]
+
+  logger.info('Received configuration request from '+sh)
+
+  if(sh not in scan_hash and os.path.isfile(host_dir+"/"+sh)):
+    load_host(sh)
+
+  if(sh in scan_hash and scan_hash[sh]['config'] is not None):
+    if(len(scan_hash[sh]['fragments']) > 0 and 'zfrag' in options[1:]):
+      logger.info('Sending configuration for '+sh+' on port '+str(port)+' ('+str(len(scan_hash[sh]['fragments']))+' fragments)')
+
+      for fragment in scan_hash[sh]['fragments']:
+        sock.sendto(fragment, (from_ip, port))
+
+    else:
+      logger.info('Sending configuration for '+sh+' on port '+str(port))
+
+      sock.sendto(scan_hash[sh]['config'], (from_ip, port))
+
+  else:
+    logger.info('Error: Unable to return configuration for host '+sh)
+
+
+
+
+# Respond to a request from an Agent to re-send configuration fragments
+# which it didn't receive ("host%%version%%index,index,...").  If the
+# configuration has changed since, the whole of the new one is sent.
+
+def do_confresend(sock, arg, from_ip):
+  global logger
+  global scan_hash
+  global port
+
+  rs = arg.split('%%')
+
+  if(len(rs) == 3 and rs[0] in scan_hash and len(scan_hash[rs[0]]['fragments']) > 0):
+    fragments = scan_hash[rs[0]]['fragments']
+
+    if(rs[1] == scan_hash[rs[0]]['version']):
+      logger.info('Re-sending configuration fragments '+rs[2]+' for '+rs[0])
+
+      for i in rs[2].split(','):
+        if(i.isdigit() and int(i) < len(fragments)):
+          sock.sendto(fragments[int(i)], (from_ip, port))
+
+    else:
+      do_confreq(sock, rs[0]+'%%zfrag', from_ip)
+
+
+
+
+# Host liveness is tracked using heartbeat_heap, a heap of
+# (deadline, host) entries ordered by the time by which each host must
+# next be heard from.  mark_seen() is called whenever a host sends
+# anything, and check_heartbeats() (called from the main loop) only looks
+# at hosts whose deadline has passed.  A "Host is inactive" event is
+# written when a host goes quiet, rather than on every check.
+
+def mark_seen(sh):
+  global scan_hash
+  global heartbeat_heap
+  global logger
+
+  if(sh in scan_hash):
+    scan_hash[sh]['agent_seen'] = int(time.time())
+
+    if(scan_hash[sh]['alive'] == False):
+      logger.info('Host '+sh+' is active again')
+      scan_hash[sh]['alive'] = True
+      heapq.heappush(heartbeat_heap, (scan_hash[sh]['agent_seen'] + max_idle_time, sh))
+
+
+
+def check_heartbeats():
+  global scan_hash
+  global heartbeat_heap
+  global event_writer
+
+  now = int(time.time())
+
+  while(len(heartbeat_heap) > 0 and heartbeat_heap[0][0] < now):
+    deadline, sh = heapq.heappop(heartbeat_heap)
+
+    if(sh in scan_hash and scan_hash[sh]['alive'] == True):
+      if((now - scan_hash[sh]['agent_seen']) > max_idle_time):
+        scan_hash[sh]['alive'] = False
+        event_writer.write(sh+'%%000000%%'+str(now)+'%%SYSTEM%%NULL%%Host is inactive')
+
+      else:
+        heapq.heappush(heartbeat_heap, (scan_hash[sh]['agent_seen'] + max_idle_time, sh))
+
+
+
+
+# Returns the host, Events (each "host%%uid%%time%%tags%%file%%message")
+# and acknowledgement of an ALERT or ALERTS datagram, or None if the
+# datagram isn't one.  An ALERTS datagram is a batch of Events - the first
+# line holds the Agent's host name, followed by one Event per line, and
+# all of the Events are acknowledged with a single ACKS.
+
+def read_alerts(udp_text):
+  m = re.match('^(ALERTS?)%%(.+)', udp_text)
+
+  if m:
+    if(m.group(1) == 'ALERT'):
+      ss = m.group(2).split('%%')
+
+      if(len(ss) > 1):
+        return(ss[0], [ m.group(2) ], 'ACK%%'+ss[1])
+
+    else:
+      events = udp_text.split('\n')[1:]
+
+      return(m.group(2), [ m.group(2)+'%%'+ev for ev in events ], 'ACKS%%'+','.join([ ev.split('%%', 1)[0] for ev in events ]))
+
+  return(None)
+
+
+
+
+# Returns the Events which should be written to the Event Stream (those
+# not suppressed), recording any metrics among them.
+
+def accept_events(events):
+  global metrics
+  global suppressor
+
+  accepted = []
+
+  for ev in events:
+    if(suppressor is None or suppressor.check(ev)):
+      accepted.append(ev)
+
+    if metrics is not None:
+      record_metric(ev)
+
+  return(accepted)
+
+
+
+
+# Handle a datagram received from an Agent (by the main process, or passed
+# on by a worker process - see worker_main()).
+
+def handle_datagram(sock, udp_data, from_ip):
+  global event_writer
+  global scan_hash
+  global port
+
+  udp_text = udp_data.decode()
+  alerts = read_alerts(udp_text)
+  stats.count('datagrams_received')
+
+  # Respond to an Event, or a batch of Events, sent by an Agent.
+  if alerts is not None:
+    host, events, ack = alerts
+
+    for ev in accept_events(events):
+      event_writer.write(ev)
+
+    stats.count('events_received', len(events))
+    event_writer.ack(sock, ack.encode(), (from_ip, port))
+    mark_seen(host)
+
+  else:
+    m = re.match('^([A-Z]+)%%(.+)', udp_text)
+
+    # Respond to a "Configuration Requested" command from an Agent.
+    if(m and m.group(1) == 'CONFREQ'):
+      stats.count('config_requests')
+      do_confreq(sock, m.group(2), from_ip)
+
+    # Respond to a request to re-send configuration fragments.
+    elif(m and m.group(1) == 'CONFRESEND'):
+      do_confresend(sock, m.group(2), from_ip)
+
+
+
+
+# Handle a batch of Events from a worker process.  Each line of the batch
+# is either "E" followed by an Event Stream line, or "A" followed by the
+# address, Event count, acknowledgement and host of an Agent's datagram
+# (after the Events it acknowledges).
+
+def handle_worker_batch(sock, batch):
+  global event_writer
+  global event_ack
+  global port
+
+  for line in batch.split(b'\n')[:-1]:
+    if(line[:1] == b'E'):
+      event_writer.write_line(line[1:]+b'\n')
+
+    elif(line[:1] == b'A'):
+      from_ip, count, ack, host = line[1:].split(b' ', 3)
+      stats.count('datagrams_received')
+      stats.count('events_received', int(count))
+
+      # With "event_ack: immediate", the worker has already sent it.
+      if(event_ack != 'immediate'):
+        event_writer.ack(sock, ack, (from_ip.decode(), port))
+
+      mark_seen(host.decode())
+
+
+
+
+# Main loop of a worker process.  When the Server is configured with
+# "workers:", several worker processes share the Agent port using
+# SO_REUSEPORT, so the kernel spreads incoming datagrams across them (an
+# Agent sends from a fixed port, so all of it's datagrams reach the same
+# worker).  Workers do the per-Event work: they validate ALERT and ALERTS
+# datagrams, suppress floods, record metrics and format the Event Stream
+# lines.  With "event_ack: immediate", they also acknowledge Events
+# straight away.  Each pass, a worker sends the main Server process a
+# batch (see handle_worker_batch()) of the lines to write and the
+# acknowledgements to release once they are written.  The main process
+# only appends the lines to the Event Stream, flushes it and releases
+# the acknowledgements, in the order batches reach it.  Other datagrams
+# (configuration requests) are passed to the main process as they are,
+# prefixed with "R" and the sender's address.
+
+def worker_main(worker_id, conn):
+  global logger
+  global port
+  global event_ack
+  global suppressor
+
+  parent_pid = os.getppid()
+
+  # Each worker logs to it's own file, rather than sharing (and rolling)
+  # the main process's ax436.log.
+  for handler in logger.handlers[:]:
+    logger.removeHandler(handler)
+    handler.close()
+
+  logger.addHandler(logging.handlers.RotatingFileHandler('ax436_worker'+str(worker_id)+'.log', maxBytes = 1000000, backupCount = 4))
+
+  w_sock = socket(AF_INET, SOCK_DGRAM)
+  w_sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+  w_sock.bind(('', port + 1))
+  w_sock.setblocking(False)
+
+  logger.info('Worker '+str(worker_id)+' started (pid '+str(os.getpid())+')')
+
+  while(os.getppid() == parent_pid):
+    readable, writable, exceptional = select.select([ w_sock ], [], [], 1.0)
+    batch = []
+    batch_size = 0
+    received = 0
+
+    # Read up to 64 datagrams each pass, so that a busy worker still sends
+    # batches often enough for the main process to flush and acknowledge.
+    while(len(readable) > 0 and received < 64):
+      try:
+        ( udp_data, from_addr ) = w_sock.recvfrom(65536)
+        received += 1
+
+      except BlockingIOError:
+        break
+
+      alerts = read_alerts(udp_data.decode())
+
+      if alerts is None:
+        conn.send(b'R'+from_addr[0].encode()+b' '+udp_data)
+
+      else:
+        host, events, ack = alerts
+
+        if(event_ack == 'immediate'):
+          w_sock.sendto(ack.encode(), (from_addr[0], port))
+
+        lines = [ b'E'+format_event(ev) for ev in accept_events(events) ]
+        lines.append(('A'+from_addr[0]+' '+str(len(events))+' '+ack+' '+host+'\n').encode())
+        size = sum([ len(line) for line in lines ])
+
+        if(batch_size + size > 65000 and len(batch) > 0):
+          conn.send(b''.join(batch))
+          batch = []
+          batch_size = 0
+
+        batch.extend(lines)
+        batch_size += size
+
+    if suppressor is not None:
+      batch.extend([ b'E'+format_event(ev) for ev in suppressor.sweep() ])
+
+    if(len(batch) > 0):
+      conn.send(b''.join(batch))
+
+  os._exit(0)
+
+
+
+
+# Starts a worker process, returning it's pid and the main process's end
+# of the Unix socket connecting them.  The new worker closes it's copies of
+# the main process's ends of the other workers' sockets ([worker_list]).
+
+def start_worker(worker_id, worker_list):
+  global logger
+
+  parent_conn, child_conn = socketpair(AF_UNIX, SOCK_DGRAM)
+  pid = os.fork()
+
+  if(pid == 0):
+    parent_conn.close()
+
+    for w in worker_list:
+      w[1].close()
+
+    try:
+      worker_main(worker_id, child_conn)
+
+    finally:
+      os._exit(1)
+
+  child_conn.close()
+  logger.info('Started worker '+str(worker_id)+' (pid '+str(pid)+')')
+
+  return([ pid, parent_conn ])
+
 
 
 
@@ -63,13 +1069,35 @@ from socket import *
 # re-initialise itself.
 
 def main(conf_file):
-  # This is the time after which an Agent is considered
-  # "dead" if that Agent doesn't send any notifications
-  # to the Server.
-  max_idle_time = 180
+  global logger
+  global event_writer
+  global metrics
+  global suppressor
+  global event_ack
+  global port
+  global host_dir
+  global include_dir
+  global scan_hash
+  global heartbeat_heap
+
+  # Number of worker processes to receive Agent datagrams with.
+  # With fewer than 2, the main process receives them itself.
+  workers = 0
+
+  # Events are written to the Event Stream in groups of up to
+  # [event_flush_bytes], or after [event_flush_interval] seconds.
+  event_flush_bytes = 65536
+  event_flush_interval = 0.2
+
+  # Folder in which to store metrics (no metrics are stored if not set).
+  metric_store_name = ''
+
+  # At most [suppress_events] similar events from a host are written in
+  # [suppress_seconds] (no events are suppressed if not set).
+  suppress_events = 0
+  suppress_seconds = 0
 
   # Initialise the general Server log - ax436.log.
-  logger = logging.getLogger(__name__)
   logger.setLevel(logging.DEBUG)
   logger.addHandler(logging.handlers.RotatingFileHandler('ax436.log', maxBytes = 1000000, backupCount = 4))
 
@@ -99,6 +1127,35 @@ def main(conf_file):
       tokens = cf.split()
       event_stream_name = tokens[1]
 
+    elif cf.startswith('workers:'):
+      tokens = cf.split()
+      workers = int(tokens[1])
+
+    elif cf.startswith('event_flush_bytes:'):
+      tokens = cf.split()
+      event_flush_bytes = int(tokens[1])
+
+    elif cf.startswith('event_flush_interval:'):
+      tokens = cf.split()
+      event_flush_interval = float(tokens[1])
+
+    elif cf.startswith('metric_store:'):
+      tokens = cf.split()
+      metric_store_name = tokens[1]
+
+    elif cf.startswith('suppress:'):
+      sm = re.match('^suppress:\s+events=(\d+)\s+seconds=(\d+)\s*$', cf)
+
+      if sm:
+        suppress_events = int(sm.group(1))
+        suppress_seconds = int(sm.group(2))
+
+    elif cf.startswith('event_ack:'):
+      tokens = cf.split()
+
+      if(tokens[1] in [ 'immediate', 'flush', 'fsync' ]):
+        event_ack = tokens[1]
+
   f.close()
 
   logger.info('Server broadcasting on port '+str(port)+' to '+bcaddr)
@@ -107,19 +1164,41 @@ def main(conf_file):
   logger.info('Additional configurations in '+include_dir)
   logger.info('Event stream is '+event_stream_name)
 
+  if(workers > 1 and 'SO_REUSEPORT' not in globals()):
+    logger.info('Error: SO_REUSEPORT is not supported - running without workers')
+    workers = 0
+
+  logger.info('Event acknowledgement policy is '+event_ack)
+
+  if(len(metric_store_name) > 0):
+    logger.info('Metric store is '+metric_store_name)
+    metrics = metric_store(metric_store_name)
+
+  if(suppress_events > 0 and suppress_seconds > 0):
+    logger.info('Suppressing more than '+str(suppress_events)+' similar events in '+str(suppress_seconds)+' seconds')
+    suppressor = event_suppressor(suppress_events, suppress_seconds)
+
   # Initialise the Server's event stream log file.
-  event_logger = logging.getLogger('ax436_event_logger')
-  event_logger.setLevel(logging.DEBUG)
-  event_logger.addHandler(logging.handlers.RotatingFileHandler(event_stream_name, maxBytes = 1000000, backupCount = 4))
+  event_writer = event_stream_writer(event_stream_name, 1000000, 4, event_flush_bytes, event_flush_interval, event_ack)
 
   addr = ('', port + 1)
   send_addr = (bcaddr, port)
 
   ad_sock = socket(AF_INET, SOCK_DGRAM)
-  ad_sock.bind(addr)
   ad_sock.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
 
-  inputs = [ ad_sock ]
+  # With workers, the main process's socket is only used for sending,
+  # so it isn't bound to the Agent port.
+  if(workers > 1):
+    worker_list = []
+
+    for w in range(workers):
+      worker_list.append(start_worker(w, worker_list))
+
+  else:
+    ad_sock.bind(addr)
+    worker_list = []
+
   outputs = []
 
   # The Agent configuration folder is scanned every [scan_interval] seconds
@@ -132,87 +1211,111 @@ def main(conf_file):
   next_i_am_here = time.time() + i_am_here_interval
 
   scan_hash = {}
+  heartbeat_heap = []
+
+  # Statistics are available to local programs on Server port + 3.
+  try:
+    stats_sock = socket(AF_INET, SOCK_DGRAM)
+    stats_sock.bind(('127.0.0.1', port + 3))
+
+  except OSError as e:
+    logger.info('Error: Unable to open stats port '+str(port + 3)+': '+str(e))
+    stats_sock = None
 
   while(True):
-    readable, writable, exceptional = select.select(inputs, outputs, inputs, 1.0)
+    if(len(worker_list) > 0):
+      inputs = [ w[1] for w in worker_list ]
+
+    else:
+      inputs = [ ad_sock ]
+
+    if stats_sock is not None:
+      inputs.append(stats_sock)
+
+    readable, writable, exceptional = select.select(inputs, outputs, inputs, event_writer.poll(1.0))
+    loop_started = time.perf_counter()
+
+    if(stats_sock is not None and stats_sock in readable):
+      gauges = [ ( 'hosts', len(scan_hash) ), ( 'hosts_inactive', len([ sh for sh in scan_hash if scan_hash[sh]['alive'] == False ]) ), ( 'workers', len(worker_list) ), ( 'buffered_events', len(event_writer.buffer) ), ( 'pending_acks', len(event_writer.pending_acks) ) ]
+
+      if metrics is not None:
+        gauges.append(( 'metric_series_open', len(metrics.series) ))
+
+      if suppressor is not None:
+        gauges.append(( 'suppression_keys', len(suppressor.key_hash) ))
+
+      stats436.answer_stats(stats_sock, lambda: stats.report(gauges))
+      readable.remove(stats_sock)
 
     for rs in readable:
-      ( udp_data, from_addr ) = rs.recvfrom(65536)
-      m = re.match('^([A-Z]+)%%(.+)', udp_data.decode())
-
-      if m:
-        cmd = m.group(1)
-        arg = m.group(2)
-
-        # Respond to a "Configuration Requested" command from an Agent.
-        if(cmd == 'CONFREQ'):
-          logger.info('Received configuration request from '+arg)
-
-          clines = 'START'
-
-          try:
-            logger.info('Loading host file '+host_dir+"/"+arg)
-
-            cfile = open(host_dir+"/"+arg)
-  
-            for c in cfile:
-              inc = re.match('^include:\s+(\S+)\s*$', c)
-  
-              if inc:
-                logger.info('Loading include file '+include_dir+"/"+inc.group(1))
-
-                ifile = open(include_dir+"/"+inc.group(1))
-  
-                for i in ifile:
-                  clines += '%%'+i.strip()
-  
-                ifile.close()
-  
-              else:
-                clines += '%%'+c.strip()
-  
-            cfile.close()
-
-            logger.info('Sending configuration for '+arg+' on port '+str(port))
-  
-            ad_sock.sendto(('CONFIG%%'+clines).encode(), (from_addr[0], port))
-
-          except IOError:
-            logger.info('Error: Unable to return configuration for host '+arg)
-
-        # Respond to an Event sent to the Server by an Agent.
-        elif(cmd == 'ALERT'):
-          event_logger.info(time.ctime()+'%%'+arg)
-          ss = arg.split('%%')
-          ad_sock.sendto(('ACK%%'+ss[1]).encode(), (from_addr[0], port))
-
-          if(ss[0] in scan_hash):
-            scan_hash[ss[0]]['agent_seen'] = int(time.time())
+      if rs is ad_sock:
+        ( udp_data, from_addr ) = rs.recvfrom(65536)
+        handle_datagram(ad_sock, udp_data, from_addr[0])
+
+      else:
+        w_data = rs.recv(131072)
+
+        if(w_data[:1] == b'R'):
+          from_ip, udp_data = w_data[1:].split(b' ', 1)
+          handle_datagram(ad_sock, udp_data, from_ip.decode())
+
+        else:
+          handle_worker_batch(ad_sock, w_data)
+
+    if suppressor is not None:
+      for ev in suppressor.sweep():
+        event_writer.write(ev)
+
+    event_writer.poll(0)
+
+    # Restart any worker processes which have died.
+    for w_idx in range(len(worker_list)):
+      if(os.waitpid(worker_list[w_idx][0], os.WNOHANG)[0] != 0):
+        logger.info('Error: Worker '+str(w_idx)+' (pid '+str(worker_list[w_idx][0])+') has died')
+        worker_list[w_idx][1].close()
+        worker_list[w_idx] = start_worker(w_idx, worker_list)
 
     # Broadcast an "I am here" heartbeat message.
     if(time.time() > next_i_am_here):
       ad_sock.sendto(('SRVHB%%'+os.uname()[1]).encode(), send_addr)
       next_i_am_here = time.time() + i_am_here_interval
 
+    check_heartbeats()
+
     # Scan the host configuration folder for changes.
+    # Hosts whose configuration includes an updated file are Reset too.
     if(time.time() > next_scan):
-      for sh in os.listdir(host_dir):
-        sst = os.stat(host_dir+'/'+sh)
+      # The include files used by hosts are checked once per scan (they
+      # can be in sub-folders of the include folder, eg. "sub/common").
+      include_hash = {}
+
+      for sh in scan_hash:
+        for i in scan_hash[sh].get('includes', {}):
+          if(i not in include_hash):
+            include_hash[i] = include_mtime(i)
+
+      for he in [ e for e in os.scandir(host_dir) if e.is_file() ]:
+        sh = he.name
+        mtime = int(he.stat().st_mtime)
 
         if(sh not in scan_hash):
-          scan_hash[sh] = { 'agent_seen': 0, 'mtime': int(sst.st_mtime) }
           logger.info('New host configuration: '+sh)
+          load_host(sh)
 
-        elif(scan_hash[sh]['mtime'] != int(sst.st_mtime)):
+        elif(scan_hash[sh]['mtime'] != mtime):
           logger.info('Host configuration '+sh+' has been updated')
-          scan_hash[sh]['mtime'] = int(sst.st_mtime)
+          load_host(sh)
           ad_sock.sendto(('RESET%%'+sh).encode(), send_addr)
 
-        if((int(time.time()) - scan_hash[sh]['agent_seen']) > max_idle_time):
-          event_logger.info(time.ctime()+'%%'+sh+'%%000000%%'+str(int(time.time()))+'%%SYSTEM%%NULL%%Host is inactive')
+        elif(any(include_hash[i] != scan_hash[sh]['includes'][i] for i in scan_hash[sh]['includes'])):
+          logger.info('An include file for host configuration '+sh+' has been updated')
+          load_host(sh)
+          ad_sock.sendto(('RESET%%'+sh).encode(), send_addr)
 
       next_scan = time.time() + scan_interval
 
+    stats.timing('main_loop', time.perf_counter() - loop_started)
+
 
 
 
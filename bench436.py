@@ -0,0 +1,433 @@
+# bench436.py
+#
+# This is the Benchmark suite for Project 436.  Everything runs on one host
+# (over loopback), without any network access:
+# - "config" times do_config() / do_unconfig() for a large Agent
+#   configuration.
+# - "active" times is_active() checks and the compiling of "active:"
+#   expressions.
+# - "match" times file_consumer pattern matching.
+# - "log" runs a synthetic log writer (at a given rate and line size,
+#   rolling the log every so often) against an Agent file tailer and
+#   consumer, and measures the time from a line being written to the
+#   Agent raising an event for it.
+# - "fleet" starts an ax436.py Server and simulates a fleet of Agents
+#   sending it events over loopback UDP, and measures how many events a
+#   second the Server writes and how long Agents wait for their ACKs.
+# Each benchmark reports a throughput and latency percentiles (p50, p90,
+# p99).  Settings can be changed with name=value arguments, eg.
+#
+#   python bench436.py fleet agents=100 events=200000 workers=4
+
+# Copyright (c) 2013, Chris Bristow
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+import sys
+import os
+import time
+import re
+import select
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+from socket import *
+
+import aa436
+
+
+
+
+# Globals:
+# Default settings for each benchmark (overridden by name=value arguments).
+
+settings = {
+  'groups': 200,           # config: number of file / process / command groups
+  'iterations': 50,        # config: number of configurations to apply
+  'checks': 1000000,       # active: number of is_active() checks
+  'patterns': 20,          # match, log: number of match: patterns
+  'lines': 200000,         # match: number of lines to match
+  'rate': 0,               # log: lines a second to write (0 = as fast as possible)
+  'line_size': 120,        # log: length of each line
+  'rotate_lines': 100000,  # log: roll the log after this many lines
+  'seconds': 10,           # log: how long to write the log for
+  'agents': 50,            # fleet: number of simulated Agents
+  'events': 100000,        # fleet: total number of events to send
+  'batch': 32,             # fleet: events per ALERTS datagram
+  'workers': 0,            # fleet: Server "workers:" setting
+  'port': 9400             # fleet: Server port (port and port + 1 are used)
+}
+
+ax436_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ax436.py')
+
+
+
+
+# Returns the p50, p90 and p99 of a list of latencies (in seconds) as a
+# string of milliseconds.
+
+def percentiles(samples):
+  if(len(samples) == 0):
+    return('no samples')
+
+  samples = sorted(samples)
+  pl = []
+
+  for p in [ 50, 90, 99 ]:
+    pl.append('p'+str(p)+'='+'{0:.3f}'.format(samples[min(len(samples) - 1, (len(samples) * p) // 100)] * 1000)+'ms')
+
+  return(' '.join(pl))
+
+
+
+def report(name, count, unit, elapsed, samples):
+  print('{0:<24} {1:>10} {2} in {3:.2f}s = {4:>12.0f} {2}/s   {5}'.format(name, count, unit, elapsed, count / max(elapsed, 0.000001), percentiles(samples)))
+
+
+
+
+# Builds an Agent configuration with [groups] log file, process and
+# command groups.
+
+def make_config(folder, groups):
+  conf = []
+
+  for g in range(groups):
+    conf += [ 'file: '+os.path.join(folder, 'log_'+str(g % 10)+'.log'),
+              'active: 12345;09:00-17:30,06;10:00-12:00',
+              'match: ERROR [0-9]+ in module_'+str(g),
+              'alert_all: tags=BENCH_'+str(g)+'  message=module '+str(g)+' error',
+              'process: bench_daemon_'+str(g),
+              'alert_running: tags=PROC_'+str(g)+'  min=1  max=2  message=bench_daemon_'+str(g)+' not running',
+              'run: builtin=loadavg',
+              'alert_if: tags=LOAD_'+str(g)+'  match=1,load  upper_limit=2,'+str(g)+'  message=Load over '+str(g) ]
+
+  return('%%'.join([ 'ps_command: ps -ef' ] + conf))
+
+
+
+def bench_config(folder):
+  conf = make_config(folder, settings['groups'])
+  samples = []
+  start = time.time()
+
+  for i in range(settings['iterations']):
+    t = time.time()
+    aa436.do_config(conf)
+    aa436.do_unconfig()
+    samples.append(time.time() - t)
+
+  report('do_config', settings['iterations'], 'configs', time.time() - start, samples)
+
+  # Re-applying a configuration (as after a Reset) only replaces the
+  # rules which have changed.
+  samples = []
+  aa436.do_config(conf)
+  start = time.time()
+
+  for i in range(settings['iterations']):
+    t = time.time()
+    aa436.do_config(conf.replace('tags=BENCH_0 ', 'tags=BENCH_'+str(i % 2)+' '))
+    samples.append(time.time() - t)
+
+  report('do_config (reconfigure)', settings['iterations'], 'configs', time.time() - start, samples)
+  aa436.do_unconfig()
+
+
+
+
+def bench_active(folder):
+  schedule = aa436.get_schedule('12345;09:00-17:30,06;10:00-12:00')
+  samples = []
+  start = time.time()
+
+  for i in range(settings['checks'] // 1000):
+    t = time.time()
+
+    for j in range(1000):
+      aa436.is_active(schedule)
+
+    samples.append((time.time() - t) / 1000)
+
+  report('is_active', settings['checks'], 'checks', time.time() - start, samples)
+
+  samples = []
+  start = time.time()
+
+  for i in range(1000):
+    t = time.time()
+    aa436.active_schedule('0123456;00:00-08:00,12345;09:00-17:30,06;10:00-12:00')
+    samples.append(time.time() - t)
+
+  report('active: compile', 1000, 'schedules', time.time() - start, samples)
+
+
+
+
+# Returns a line of about [size] characters.  One line in ten matches one
+# of [patterns] match: patterns.
+
+def make_line(n, patterns, size):
+  if(n % 10 == 0):
+    line = str(time.time())+' '+str(n)+' ERROR '+str(n)+' in module_'+str(n % patterns)+' '
+
+  else:
+    line = str(time.time())+' '+str(n)+' INFO request '+str(n)+' handled by worker_'+str(n % 7)+' '
+
+  return(line + ('x' * max(0, size - len(line))))
+
+
+
+def bench_match(folder):
+  patterns = [ 'ERROR [0-9]+ in module_'+str(p)+' ' for p in range(settings['patterns']) ]
+  consumer = aa436.file_consumer(os.path.join(folder, 'match.log'), patterns, { 'tags': 'BENCH' }, '')
+  lines = [ make_line(n, settings['patterns'], 120) for n in range(settings['lines']) ]
+  samples = []
+  start = time.time()
+
+  for b in range(0, len(lines), 1000):
+    t = time.time()
+    consumer.consume(lines[b:b + 1000])
+    samples.append(time.time() - t)
+    consumer.list = []
+
+  report('match ('+str(settings['patterns'])+' patterns)', len(lines), 'lines', time.time() - start, samples)
+  aa436.do_unconfig()
+
+
+
+
+# Writes a log file at [rate] lines a second (or as fast as possible),
+# rolling it (log -> log.1) every [rotate_lines] lines, for [seconds].
+
+def log_writer(filename, state):
+  n = 0
+  f = open(filename, 'a')
+  end = time.time() + settings['seconds']
+
+  while(time.time() < end):
+    f.write(make_line(n, settings['patterns'], settings['line_size'])+'\n')
+    n += 1
+
+    if(n % settings['rotate_lines'] == 0):
+      f.close()
+      os.replace(filename, filename+'.1')
+      f = open(filename, 'a')
+
+    if(settings['rate'] > 0):
+      if(n % 100 == 0):
+        f.flush()
+        time.sleep(max(0, (state['start'] + (n / settings['rate'])) - time.time()))
+
+    elif(n % 1000 == 0):
+      f.flush()
+
+  f.close()
+  state['written'] = n
+
+
+
+def bench_log(folder):
+  filename = os.path.join(folder, 'bench.log')
+  open(filename, 'w').close()
+  patterns = [ 'ERROR [0-9]+ in module_'+str(p)+' ' for p in range(settings['patterns']) ]
+  consumer = aa436.file_consumer(filename, patterns, { 'tags': 'BENCH' }, '')
+  tailer = aa436.get_file_tailer(filename)
+  tailer.read()
+
+  state = { 'start': time.time(), 'written': None }
+  writer = threading.Thread(target = log_writer, args = ( filename, state ))
+  writer.start()
+
+  read = 0
+  events = 0
+  samples = []
+
+  while(state['written'] is None or read < state['written']):
+    lines = tailer.read()
+
+    if(len(lines) > 0):
+      read += len(lines)
+      consumer.consume(lines)
+      now = time.time()
+
+      for alert in consumer.read():
+        samples.append(now - float(alert.split('%%', 2)[2].split(' ', 1)[0]))
+        events += 1
+
+    elif(state['written'] is not None):
+      break
+
+    else:
+      time.sleep(0.01)
+
+  elapsed = time.time() - state['start']
+  writer.join()
+  report('log lines read', read, 'lines', elapsed, [])
+  report('log events', events, 'events', elapsed, samples)
+  aa436.do_unconfig()
+
+
+
+
+# Starts an ax436.py Server in [folder], then has [agents] simulated
+# Agents each send events in ALERTS datagrams of [batch] events, sending
+# their next datagram as soon as the last one has been acknowledged.  The
+# Server sends ACKs to the Agent port ([port]) of the sending host, so all
+# of the simulated Agents share one socket, and the ACKed event ids show
+# which Agent each ACK is for.
+
+def bench_fleet(folder):
+  port = settings['port']
+  os.mkdir(os.path.join(folder, 'hosts'))
+  os.mkdir(os.path.join(folder, 'includes'))
+
+  for a in range(settings['agents']):
+    open(os.path.join(folder, 'hosts', 'bench'+str(a)), 'w').close()
+
+  with open(os.path.join(folder, 'bench.conf'), 'w') as f:
+    f.write('event_stream: events.log\nport: '+str(port)+'\nbroadcast: 127.0.0.1\nhosts: hosts\nincludes: includes\nworkers: '+str(settings['workers'])+'\n')
+
+  server = subprocess.Popen([ sys.executable, ax436_path, 'bench.conf' ], cwd = folder)
+  sock = socket(AF_INET, SOCK_DGRAM)
+  sock.bind(('', port))
+  server_addr = ('127.0.0.1', port + 1)
+
+  # Wait for the Server's first "I am here" broadcast.
+  sock.settimeout(10)
+
+  try:
+    while not sock.recv(65536).startswith(b'SRVHB%%'):
+      pass
+
+  except OSError:
+    print('Error: The Server did not start')
+    server.kill()
+    return
+
+  per_agent = settings['events'] // settings['agents']
+  sent = [ 0 ] * settings['agents']
+  sent_time = [ 0 ] * settings['agents']
+  samples = []
+  retries = 0
+
+  def send_batch(a):
+    count = min(settings['batch'], per_agent - sent[a])
+    epoch = str(int(time.time()))
+    evs = [ str(a)+'_'+str(sent[a] + e)+'%%'+epoch+'%%BENCH%%/var/log/bench.log%%Benchmark event '+str(sent[a] + e)+' from agent '+str(a) for e in range(count) ]
+    sock.sendto(('ALERTS%%bench'+str(a)+'\n'+'\n'.join(evs)).encode(), server_addr)
+    sent_time[a] = time.time()
+    return(count)
+
+  batch_size = [ send_batch(a) for a in range(settings['agents']) ]
+  waiting = settings['agents']
+  start = time.time()
+
+  while(waiting > 0):
+    readable, writable, exceptional = select.select([ sock ], [], [], 1.0)
+
+    if(len(readable) > 0):
+      m = re.match(b'^ACKS%%([0-9]+)_([0-9]+)', sock.recv(65536))
+
+      # Ignore ACKs for datagrams which were re-sent and already ACKed.
+      if(m and int(m.group(2)) == sent[int(m.group(1))]):
+        a = int(m.group(1))
+        samples.append(time.time() - sent_time[a])
+        sent[a] += batch_size[a]
+
+        if(sent[a] < per_agent):
+          batch_size[a] = send_batch(a)
+
+        else:
+          waiting -= 1
+
+    # Re-send any datagrams which haven't been acknowledged in 2 seconds.
+    for a in range(settings['agents']):
+      if(sent[a] < per_agent and time.time() > sent_time[a] + 2):
+        batch_size[a] = send_batch(a)
+        retries += 1
+
+  elapsed = time.time() - start
+  server.terminate()
+  server.wait()
+  sock.close()
+
+  written = 0
+
+  for ef in os.listdir(folder):
+    if(ef.startswith('events.log') and not ef.endswith('.idx')):
+      with open(os.path.join(folder, ef), 'rb') as f:
+        written += f.read().count(b'%%BENCH%%')
+
+  report('fleet events ACKed', sum(sent), 'events', elapsed, samples)
+  print('{0:<24} {1:>10} events written, {2} datagrams re-sent'.format('fleet events written', written, retries))
+
+
+
+
+# Start hook.
+
+benchmarks = { 'config': bench_config, 'active': bench_active, 'match': bench_match, 'log': bench_log, 'fleet': bench_fleet }
+
+usage = 'Usage: bench436.py [all|'+'|'.join(benchmarks)+'] [name=value ...]\n       settings: '+' '.join([ k+'='+str(settings[k]) for k in settings ])
+
+if __name__ == '__main__':
+  selected = []
+
+  for arg in sys.argv[1:]:
+    sm = re.match('^([a-z_]+)=([0-9]+)$', arg)
+
+    if(arg == 'all'):
+      selected += list(benchmarks)
+
+    elif(arg in benchmarks):
+      selected.append(arg)
+
+    elif(sm and sm.group(1) in settings):
+      settings[sm.group(1)] = int(sm.group(2))
+
+    else:
+      print(usage)
+      exit(1)
+
+  if(len(selected) == 0):
+    selected = list(benchmarks)
+
+  # The Agent code logs to aa436.log when run as an Agent - here its log
+  # output is discarded.
+  aa436.logger.addHandler(logging.NullHandler())
+  aa436.logger.propagate = False
+
+  for name in selected:
+    folder = tempfile.mkdtemp(prefix = 'bench436_')
+
+    try:
+      benchmarks[name](folder)
+
+    finally:
+      shutil.rmtree(folder)
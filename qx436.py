@@ -0,0 +1,312 @@
+# qx436.py
+#
+# This is the Query tool for Project 436.  It reads the data stored by
+# the Server (ax436.py) and prints it:
+# - "series" lists the metric series in a metric store.
+# - "metrics" prints the values of a metric series over a period of
+#   time, with per-period (raw, minute or hour) aggregates.
+# - "events" prints the events in an Event Stream (and it's rolled copies)
+#   from a host, with a tag or within a period, using the Event Stream
+#   indexes to read only the parts of the files which hold them.
+# - "stats" prints the performance statistics of an Agent or Server
+#   running on this host.
+
+# Copyright (c) 2013, Chris Bristow
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+import sys
+import os
+import time
+import re
+from socket import *
+
+import ax436
+import stats436
+
+
+
+
+# Converts a time argument to epoch seconds.  Times can be given as
+# epoch seconds or relative to now, such as "-90s", "-30m", "-2h", "-7d".
+
+time_units = { 's': 1, 'm': 60, 'h': 3600, 'd': 86400 }
+
+def parse_time(t, now):
+  m = re.match('^-([0-9]+)([smhd])$', t)
+
+  if m:
+    return(now - (int(m.group(1)) * time_units[m.group(2)]))
+
+  elif(t == 'now'):
+    return(now)
+
+  else:
+    return(int(t))
+
+
+
+
+# Picks the finest tier which covers the whole of a period.
+
+def pick_tier(series, t_from, t_to):
+  if(series.raw_start() <= t_from):
+    return('raw')
+
+  elif(t_from >= t_to - (ax436.metric_tiers[1][1] * ax436.metric_tiers[1][2])):
+    return('1m')
+
+  else:
+    return('1h')
+
+
+
+
+def format_value(v):
+  return('{0:.6g}'.format(v))
+
+
+
+
+# Lists the series in a metric store.
+
+def do_series(store_folder):
+  if not os.path.isdir(store_folder):
+    print('Error: No such metric store: '+store_folder)
+    exit(1)
+
+  store = ax436.metric_store(store_folder, read_only = True)
+
+  for series in store.list_series():
+    print('%%'.join(series))
+
+
+
+
+# Prints the values of a metric series from [t_from] to [t_to], followed
+# by aggregates for the whole period.
+
+def do_metrics(store_folder, host, tags, filename, t_from, t_to, tier):
+  if not os.path.isdir(store_folder):
+    print('Error: No such metric store: '+store_folder)
+    exit(1)
+
+  store = ax436.metric_store(store_folder, read_only = True)
+
+  if not os.path.exists(store.series_file(host, tags, filename)):
+    print('Error: No such series: '+host+'%%'+tags+'%%'+filename)
+    exit(1)
+
+  series = store.get(host, tags, filename, False)
+
+  if(tier == ''):
+    tier = pick_tier(series, t_from, t_to)
+
+  records = series.query(tier, t_from, t_to)
+  count = 0
+  total = 0.0
+  vmin = None
+  vmax = None
+
+  print('# '+tier+' '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t_from))+' - '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t_to)))
+
+  for ts, r_count, r_total, r_min, r_max in records:
+    print(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))+' count='+str(r_count)+' avg='+format_value(r_total / r_count)+' min='+format_value(r_min)+' max='+format_value(r_max))
+    count += r_count
+    total += r_total
+
+    if(vmin is None or r_min < vmin):
+      vmin = r_min
+
+    if(vmax is None or r_max > vmax):
+      vmax = r_max
+
+  if(count > 0):
+    print('# total count='+str(count)+' sum='+format_value(total)+' avg='+format_value(total / count)+' min='+format_value(vmin)+' max='+format_value(vmax))
+
+  else:
+    print('# total count=0')
+
+
+
+
+# Returns whether an Event Stream line is from [host] (or any host, if
+# None), has [tags] and was raised between [t_from] and [t_to].
+
+def event_matches(line, host, tags, t_from, t_to):
+  ev = line.split(b'%%', 5)
+
+  return(len(ev) == 6 and ev[3].isdigit() and (host is None or ev[1] == host.encode()) and (tags is None or ev[4] == tags.encode()) and int(ev[3]) >= t_from and int(ev[3]) <= t_to)
+
+
+
+
+# Prints the matching events from an Event Stream file.  The ranges of the
+# file given by the file's index are read, followed by anything written
+# after the last indexed event.
+
+def scan_stream_file(filename, host, tags, t_from, t_to):
+  entries = ax436.read_event_index(filename)
+  indexed = max([ 0 ] + [ e[4] for e in entries ])
+  ranges = []
+
+  for block, e_host, e_tags, first, end in entries:
+    if(block >= t_from // ax436.event_index_block and block <= t_to // ax436.event_index_block and (host is None or e_host == host) and (tags is None or e_tags == tags)):
+      ranges.append([ first, end ])
+
+  # Merge overlapping ranges, so each event is only printed once.
+  ranges.sort()
+  merged = []
+
+  for r in ranges:
+    if(len(merged) > 0 and r[0] <= merged[-1][1]):
+      merged[-1][1] = max(merged[-1][1], r[1])
+
+    else:
+      merged.append(r)
+
+  out = sys.stdout.buffer
+
+  with open(filename, 'rb') as f:
+    for first, end in merged:
+      f.seek(first)
+
+      for line in f.read(end - first).splitlines(True):
+        if event_matches(line, host, tags, t_from, t_to):
+          out.write(line)
+
+    f.seek(indexed)
+
+    for line in f:
+      if event_matches(line, host, tags, t_from, t_to):
+        out.write(line)
+
+
+
+
+# Prints the matching events from an Event Stream and it's rolled copies,
+# oldest first.  Filters are given as host=, tags=, from= and to=.
+
+def do_events(stream_file, filters):
+  if not os.path.exists(stream_file):
+    print('Error: No such event stream: '+stream_file)
+    exit(1)
+
+  now = int(time.time())
+  host = None
+  tags = None
+  t_from = 0
+  t_to = now + 86400
+
+  for f in filters:
+    fm = re.match('^(host|tags|from|to)=(\S+)$', f)
+
+    if not fm:
+      print(usage)
+      exit(1)
+
+    elif(fm.group(1) == 'host'):
+      host = fm.group(2)
+
+    elif(fm.group(1) == 'tags'):
+      tags = fm.group(2)
+
+    elif(fm.group(1) == 'from'):
+      t_from = parse_time(fm.group(2), now)
+
+    else:
+      t_to = parse_time(fm.group(2), now)
+
+  stream_files = [ stream_file+'.'+str(i) for i in range(4, 0, -1) ] + [ stream_file ]
+
+  for sf in stream_files:
+    if os.path.exists(sf):
+      scan_stream_file(sf, host, tags, t_from, t_to)
+
+
+
+
+# Asks an Agent (port = Agent port + 2) or Server (port = Server port + 3)
+# on this host for it's statistics, and prints them.
+
+def do_stats(port):
+  sock = socket(AF_INET, SOCK_DGRAM)
+  sock.settimeout(5)
+  sock.sendto(stats436.stats_request, ('127.0.0.1', port))
+
+  try:
+    print(sock.recv(65536).decode())
+
+  except OSError:
+    print('Error: No statistics received from port '+str(port))
+    exit(1)
+
+
+
+
+# Start hook.
+
+usage = '''Usage: qx436.py series store_folder
+       qx436.py metrics store_folder host tags file [from [to [raw|1m|1h]]]
+       qx436.py events event_stream [host=host] [tags=tags] [from=time] [to=time]
+       qx436.py stats port'''
+
+if __name__ == '__main__':
+  if(len(sys.argv) == 3 and sys.argv[1] == 'series'):
+    do_series(sys.argv[2])
+
+  elif(len(sys.argv) >= 6 and len(sys.argv) <= 9 and sys.argv[1] == 'metrics'):
+    now = int(time.time())
+    args = sys.argv[6:] + [ '-1h', 'now', '' ][len(sys.argv) - 6:]
+
+    try:
+      t_from = parse_time(args[0], now)
+      t_to = parse_time(args[1], now)
+
+    except ValueError:
+      print(usage)
+      exit(1)
+
+    if(args[2] not in [ '', 'raw', '1m', '1h' ]):
+      print(usage)
+      exit(1)
+
+    do_metrics(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], t_from, t_to, args[2])
+
+  elif(len(sys.argv) >= 3 and sys.argv[1] == 'events'):
+    try:
+      do_events(sys.argv[2], sys.argv[3:])
+
+    except ValueError:
+      print(usage)
+      exit(1)
+
+  elif(len(sys.argv) == 3 and sys.argv[1] == 'stats' and sys.argv[2].isdigit()):
+    do_stats(int(sys.argv[2]))
+
+  else:
+    print(usage)
+    exit(1)
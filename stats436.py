@@ -0,0 +1,148 @@
+# stats436.py
+#
+# This is the statistics module for Project 436, shared by the Server
+# (ax436.py) and Agent (aa436.py), which keep statistics about their own
+# performance, and the Query tool (qx436.py), which fetches them.  Keeping
+# them in one place means the Server, Agents and Query tool all agree on
+# the histogram buckets and the text sent in reply to a "STATS" request.
+
+# Copyright (c) 2013, Chris Bristow
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+
+import time
+import bisect
+
+
+
+
+# A stats_collector keeps a program's own performance statistics:
+# counters (eg. log lines read), and histograms of how long things take
+# (eg. each pass of the main loop).  Histograms count times into fixed
+# buckets, so recording a time is cheap and percentiles are approximate
+# (the upper bound of the bucket they fall in).
+
+stats_buckets = [ 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0 ]
+stats_request = b'STATS'
+
+class stats_collector:
+  def __init__(self):
+    self.counters = {}
+    self.histograms = {}
+    self.last_counters = {}
+    self.last_histograms = {}
+    self.started = time.time()
+
+
+
+  def count(self, name, n = 1):
+    self.counters[name] = self.counters.get(name, 0) + n
+
+
+
+  def timing(self, name, seconds):
+    if(name not in self.histograms):
+      self.histograms[name] = [ 0 ] * (len(stats_buckets) + 3)
+
+    h = self.histograms[name]
+    h[bisect.bisect_left(stats_buckets, seconds)] += 1
+    h[-2] += seconds
+    h[-1] = max(h[-1], seconds)
+
+
+
+  # Returns the [p]th percentile (in seconds) of a list of bucket counts.
+
+  def percentile(self, buckets, p):
+    total = sum(buckets)
+    seen = 0
+
+    for b in range(len(buckets)):
+      seen += buckets[b]
+
+      if(total > 0 and seen * 100 >= total * p):
+        return(stats_buckets[min(b, len(stats_buckets) - 1)])
+
+    return(0.0)
+
+
+
+  # Returns the statistics as text, one per line.  [gauges] is a list of
+  # ( name, value ) pairs for values which are measured when asked for
+  # (eg. the length of the alert queue).
+
+  def report(self, gauges):
+    lines = [ 'uptime '+str(int(time.time() - self.started)) ]
+    lines += [ name+' '+str(value) for name, value in gauges ]
+    lines += [ name+' '+str(self.counters[name]) for name in sorted(self.counters) ]
+
+    for name in sorted(self.histograms):
+      h = self.histograms[name]
+      buckets = h[:len(stats_buckets) + 1]
+      lines.append(name+' count='+str(sum(buckets))+' sum='+'{0:.6f}'.format(h[-2])+' max='+'{0:.6f}'.format(h[-1])+' p50<='+str(self.percentile(buckets, 50))+' p90<='+str(self.percentile(buckets, 90))+' p99<='+str(self.percentile(buckets, 99)))
+
+    return('\n'.join(lines))
+
+
+
+  # Returns a list of ( name, value ) metrics covering the time since the
+  # last call: the increase in each counter, and the count and 99th
+  # percentile (in milliseconds) of each histogram.
+
+  def interval_metrics(self):
+    metrics = []
+
+    for name in sorted(self.counters):
+      metrics.append(( name, self.counters[name] - self.last_counters.get(name, 0) ))
+
+    for name in sorted(self.histograms):
+      buckets = self.histograms[name][:len(stats_buckets) + 1]
+      last = self.last_histograms.get(name, [ 0 ] * len(buckets))
+      interval = [ buckets[b] - last[b] for b in range(len(buckets)) ]
+      metrics.append(( name+'_count', sum(interval) ))
+
+      if(sum(interval) > 0):
+        metrics.append(( name+'_p99_ms', self.percentile(interval, 99) * 1000 ))
+
+      self.last_histograms[name] = buckets
+
+    self.last_counters = dict(self.counters)
+
+    return(metrics)
+
+
+
+
+
+# Answers a request waiting on a stats socket.  [report] is called to
+# produce the statistics, only if the request is a "STATS" request.
+
+def answer_stats(sock, report):
+  ( stats_req, stats_addr ) = sock.recvfrom(1024)
+
+  if(stats_req.strip() == stats_request):
+    sock.sendto(report().encode()[:65000], stats_addr)